@@ -0,0 +1,143 @@
+"""Offline poll-cycle benchmark for getStats against a simulated BT-2 hub.
+
+    python bench/benchmark.py --batteries 4 --controllers 1 --notify-latency 0.03
+
+Reports, per poll cycle, the wall time, Modbus round trips, event loop
+iterations (wakeups) and the peak memory allocated while the cycle ran,
+for block reads and for the old one-read-per-register plan side by side.
+Needs bleak installed, but no Bluetooth hardware.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import time
+import tracemalloc
+
+from simhub import SimulatedHub
+
+from renogy import device  # noqa: E402 (path set up by simhub)
+from renogy.transport import ModbusTimeout, ModbusTransport  # noqa: E402
+
+
+class CountingEventLoop(asyncio.SelectorEventLoop):
+    """Event loop that counts how many times it wakes up."""
+
+    wakeups = 0
+
+    def _run_once(self):
+        self.wakeups += 1
+        super()._run_once()
+
+
+async def run_cycles(hub: SimulatedHub, args, maxGap: int, maxWords: int) -> dict:
+    loop = asyncio.get_running_loop()
+    batteryList = list(range(48, 48 + args.batteries))
+    controllerList = list(range(97, 97 + args.controllers))
+    schedule = device.PollSchedule(maxGap, maxWords)
+    for battery in batteryList:
+        # The coordinator knows cell counts from the identity read
+        schedule.setCellCount(battery, args.cells)
+    device.warmFrameCache(batteryList, controllerList, schedule=schedule)
+    transport = ModbusTransport(
+        hub,
+        args.timeout,
+        write_without_response=not args.with_response,
+        window=args.window,
+    )
+    await transport.start()
+
+    times, writes, wakeups, peaks = [], [], [], []
+    failures = 0
+    for _ in range(args.cycles):
+        hub.reset_counters()
+        startWakeups = loop.wakeups
+        tracemalloc.reset_peak()
+        startMemory = tracemalloc.get_traced_memory()[0]
+        for battery in batteryList:
+            schedule.forget(battery)
+        for controller in controllerList:
+            schedule.forget(controller)
+        start = time.perf_counter()
+        try:
+            await device.getStats(
+                transport, batteryList, controllerList, schedule=schedule
+            )
+        except ModbusTimeout:
+            failures += 1
+        times.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1] - startMemory)
+        writes.append(hub.writes + hub.gatt_reads)
+        wakeups.append(loop.wakeups - startWakeups)
+    return {
+        "cycle ms (median)": statistics.median(times) * 1000,
+        "cycle ms (max)": max(times) * 1000,
+        "round trips": statistics.median(writes),
+        "wakeups": statistics.median(wakeups),
+        "peak KiB": statistics.median(peaks) / 1024,
+        "failed cycles": failures,
+        "window fallbacks": transport.fallbacks,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batteries", type=int, default=4)
+    parser.add_argument("--controllers", type=int, default=1)
+    parser.add_argument("--cells", type=int, default=4)
+    parser.add_argument("--cycles", type=int, default=20)
+    parser.add_argument("--write-latency", type=float, default=0.0)
+    parser.add_argument("--notify-latency", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--notify-chunk", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bus-latency", type=float, default=0.0)
+    parser.add_argument("--drop-when-busy", action="store_true")
+    parser.add_argument(
+        "--window", type=int, default=1, help="requests in flight at once"
+    )
+    parser.add_argument(
+        "--with-response",
+        action="store_true",
+        help="wait for a write response on every request",
+    )
+    args = parser.parse_args()
+
+    plans = {
+        "block": (device.MAX_BLOCK_GAP, device.MAX_BLOCK_WORDS),
+        "per-register": (0, 1),
+    }
+    results = {}
+    tracemalloc.start()
+    for name, (maxGap, maxWords) in plans.items():
+        hub = SimulatedHub(
+            batteries=range(48, 48 + args.batteries),
+            controllers=range(97, 97 + args.controllers),
+            write_latency=args.write_latency,
+            notify_latency=args.notify_latency,
+            drop_rate=args.drop_rate,
+            notify_chunk=args.notify_chunk,
+            seed=args.seed,
+            cells=args.cells,
+            bus_latency=args.bus_latency,
+            drop_when_busy=args.drop_when_busy,
+        )
+        loop = CountingEventLoop()
+        try:
+            results[name] = loop.run_until_complete(
+                run_cycles(hub, args, maxGap, maxWords)
+            )
+        finally:
+            loop.close()
+    tracemalloc.stop()
+
+    print(f"{'':20}" + "".join(f"{name:>14}" for name in results))
+    for metric in next(iter(results.values())):
+        row = "".join(f"{r[metric]:>14.2f}" for r in results.values())
+        print(f"{metric:20}{row}")
+
+
+if __name__ == "__main__":
+    main()
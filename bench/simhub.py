@@ -0,0 +1,246 @@
+"""A fake BleakClient that behaves like a BT-2 hub with devices on RS485.
+
+Only what the polling engine touches is emulated: start_notify,
+write_gatt_char, read_gatt_char and disconnect. Requests are answered from
+an in-memory register table after a configurable delay, and frames can be
+dropped or split into several notifications to exercise the error paths.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import struct
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "custom_components", "renogy")
+)
+
+from renogy.registers import CONTROLLER_REGISTERS, batteryRegisters  # noqa: E402
+from renogy.transport import WRITE_SERVICE_UUID  # noqa: E402
+from renogy.Utils import crc16_modbus  # noqa: E402
+
+# Raw register values the simulated devices report, before multipliers
+BATTERY_VALUES = {
+    **{f"cell{n}Voltage": 33 for n in range(1, 17)},
+    **{f"cell{n}Temperature": 214 + n % 3 for n in range(1, 17)},
+    "current": -250,
+    "voltage": 133,
+    "remainingCapacity": 76500,
+    "totalCapacity": 100000,
+    "cycleCount": 42,
+    "chargeCurentLimit": 5000,
+    "dischargeCurentLimit": 10000,
+}
+
+CONTROLLER_VALUES = {
+    "batterySoc": 87,
+    "batteryVoltage": 134,
+    "chargingCurrent": 1650,
+    "controllerTemperature": 31,
+    "batteryTemperature": -4,
+    "alternatorVoltage": 141,
+    "alternatorCurrent": 123,
+    "alternatorPower": 173,
+    "solarVoltage": 198,
+    "solarCurrent": 45,
+    "solarPower": 89,
+    "batteryMinVoltageToday": 126,
+    "batteryMaxVoltageToday": 144,
+    "maxChargingCurrentToday": 2010,
+    "maxChargingPowerToday": 285,
+    "chargingAmpHoursToday": 37,
+    "powerGenerationToday": 492,
+    "operatingDays": 211,
+    "batteryFullCharges": 148,
+    "totalChargingAmpHours": 70123,
+    "totalPowerGeneration": 912345,
+    "chargingState": 2,
+}
+
+MODEL_NUMBER = b"BT-TH-SIM"
+
+# Identity registers, as {register: ascii text or int}
+BATTERY_IDENTITY = {
+    5000: 4,
+    5110: "SIM00000001",
+    5122: "RBT100LFP12S-SIM",
+    5130: "V1.0",
+}
+CONTROLLER_IDENTITY = {0x0C: "RBC30D1S-SIM", 0x14: 0x00010203, 0x18: 12345678}
+
+
+def build_registers(schema, values: dict) -> dict[int, int]:
+    """Lay a register schema's values out as a {register: word} table."""
+    registers = {}
+    for r in schema:
+        value = values.get(r.name, 0)
+        if r.bits is not None:
+            shift, width = r.bits
+            if value < 0:
+                value = 1 << (width - 1) | -value
+            registers[r.register] = registers.get(r.register, 0) | value << shift
+            continue
+        raw = value.to_bytes(r.words * 2, "big", signed=True)
+        for i in range(r.words):
+            registers[r.register + i] = int.from_bytes(raw[i * 2 : i * 2 + 2], "big")
+    return registers
+
+
+def build_identity(identity: dict) -> dict[int, int]:
+    """Lay identity values out as a {register: word} table."""
+    registers = {}
+    for register, value in identity.items():
+        if isinstance(value, str):
+            raw = value.encode("ascii").ljust(16, b"\x00")
+        else:
+            raw = value.to_bytes(4 if value > 0xFFFF else 2, "big")
+        for i in range(0, len(raw), 2):
+            registers[register + i // 2] = int.from_bytes(raw[i : i + 2], "big")
+    return registers
+
+
+class SimulatedCharacteristic:
+    def __init__(self, properties: list[str]) -> None:
+        self.properties = properties
+
+
+class SimulatedServices:
+    """Just enough of BleakGATTServiceCollection to look the write UUID up."""
+
+    def __init__(self, properties: list[str]) -> None:
+        self._write = SimulatedCharacteristic(properties)
+
+    def get_characteristic(self, uuid) -> SimulatedCharacteristic | None:
+        return self._write if uuid == WRITE_SERVICE_UUID else None
+
+
+class SimulatedHub:
+    """Stand-in for a BleakClient connected to a BT-2 hub."""
+
+    def __init__(
+        self,
+        batteries=(48,),
+        controllers=(97,),
+        write_latency: float = 0.0,
+        notify_latency: float = 0.0,
+        drop_rate: float = 0.0,
+        notify_chunk: int | None = None,
+        seed: int | None = None,
+        cells: int = 4,
+        write_without_response: bool = True,
+        bus_latency: float = 0.0,
+        drop_when_busy: bool = False,
+    ) -> None:
+        """init.
+
+        write_latency is how long a write with response takes, notify_latency
+        how long after the write the response notification arrives, drop_rate
+        the chance a request is never answered and notify_chunk the largest
+        notification the hub sends (None sends each frame whole). cells
+        is how many cells each battery reports. write_without_response is
+        whether the write characteristic allows it.
+
+        bus_latency is how long each transaction holds the RS485 bus, which
+        only carries one at a time, so requests that arrive together are
+        answered one after the other. drop_when_busy makes the hub ignore
+        a request that arrives while the bus is busy, like a hub without a
+        request queue.
+        """
+        self.address = "00:00:00:00:00:00"
+        self.write_latency = write_latency
+        self.notify_latency = notify_latency
+        self.drop_rate = drop_rate
+        self.notify_chunk = notify_chunk
+        self.bus_latency = bus_latency
+        self.drop_when_busy = drop_when_busy
+        self._bus_free = 0.0
+        self.is_connected = True
+        properties = ["write"]
+        if write_without_response:
+            properties.append("write-without-response")
+        self.services = SimulatedServices(properties)
+        self.devices: dict[int, dict[int, int]] = {}
+        for battery in batteries:
+            self.devices[battery] = build_registers(
+                batteryRegisters(cells), BATTERY_VALUES
+            ) | build_identity({**BATTERY_IDENTITY, 5000: cells})
+        for controller in controllers:
+            self.devices[controller] = build_registers(
+                CONTROLLER_REGISTERS, CONTROLLER_VALUES
+            ) | build_identity(CONTROLLER_IDENTITY)
+        self._random = random.Random(seed)
+        self._callback = None
+        self.writes = 0
+        self.notifications = 0
+        self.dropped = 0
+        self.gatt_reads = 0
+
+    def reset_counters(self) -> None:
+        self.writes = 0
+        self.notifications = 0
+        self.dropped = 0
+        self.gatt_reads = 0
+
+    async def start_notify(self, uuid, callback) -> None:
+        self._callback = callback
+
+    async def stop_notify(self, uuid) -> None:
+        self._callback = None
+
+    async def read_gatt_char(self, uuid) -> bytearray:
+        self.gatt_reads += 1
+        if self.write_latency:
+            await asyncio.sleep(self.write_latency)
+        return bytearray(MODEL_NUMBER)
+
+    async def disconnect(self) -> bool:
+        self.is_connected = False
+        return True
+
+    def respond(self, request: bytes) -> bytes | None:
+        """Work out the frame the hub would answer a request with."""
+        if crc16_modbus(request[:-2]) != request[-2:]:
+            return None
+        device_id, function, register, count = struct.unpack(">BBHH", request[:6])
+        registers = self.devices.get(device_id)
+        if registers is None:
+            return None
+        if function != 3:
+            # Illegal function
+            frame = bytes([device_id, function | 0x80, 0x01])
+        elif not any(register + i in registers for i in range(count)):
+            # Illegal data address, like a real device asked for another
+            # device type's registers. Gaps inside a known range read as 0.
+            frame = bytes([device_id, function | 0x80, 0x02])
+        else:
+            payload = b"".join(
+                registers.get(register + i, 0).to_bytes(2, "big") for i in range(count)
+            )
+            frame = bytes([device_id, function, len(payload)]) + payload
+        return frame + crc16_modbus(frame)
+
+    async def write_gatt_char(self, uuid, data, response: bool = False) -> None:
+        self.writes += 1
+        if response and self.write_latency:
+            await asyncio.sleep(self.write_latency)
+        frame = self.respond(bytes(data))
+        if frame is None or self._random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self.drop_when_busy and self._bus_free > now:
+            self.dropped += 1
+            return
+        done = self._bus_free = max(now, self._bus_free) + self.bus_latency
+        loop.call_at(done + self.notify_latency, self._notify, frame)
+
+    def _notify(self, frame: bytes) -> None:
+        if self._callback is None:
+            return
+        chunk = self.notify_chunk or len(frame)
+        for i in range(0, len(frame), chunk):
+            self.notifications += 1
+            self._callback(None, bytearray(frame[i : i + chunk]))
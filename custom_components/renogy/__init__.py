@@ -1,26 +1,42 @@
 """The renogy integration."""
 from __future__ import annotations
 
-
-from bleak import BleakClient, BleakError
-from bleak.backends.device import BLEDevice
-
-from bleak_retry_connector import (
-    close_stale_connections_by_address,
-    establish_connection,
-)
+from bleak_retry_connector import close_stale_connections_by_address
 from homeassistant.components import bluetooth
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.const import Platform
-from homeassistant.core import HomeAssistant
-from homeassistant.exceptions import ConfigEntryNotReady
-from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP, Platform
+from homeassistant.core import (
+    Event,
+    HomeAssistant,
+    ServiceCall,
+    ServiceResponse,
+    SupportsResponse,
+    callback,
+)
+from homeassistant.exceptions import ServiceValidationError
+from homeassistant.helpers import (
+    config_validation as cv,
+    device_registry as dr,
+    entity_registry as er,
+)
 import logging
-from datetime import timedelta
-
-from .const import DEFAULT_SCAN_INTERVAL, DOMAIN
-
-from .renogy.device import getStats
+import time
+import voluptuous as vol
+
+from .const import (
+    CONF_PRESENCE_TIMEOUT,
+    CONF_REQUEST_WINDOW,
+    CONF_SAMPLE_INTERVAL,
+    CONF_WRITE_WITHOUT_RESPONSE,
+    DEFAULT_PRESENCE_TIMEOUT,
+    DEFAULT_REQUEST_WINDOW,
+    DEFAULT_SAMPLE_INTERVAL,
+    DEFAULT_WRITE_WITHOUT_RESPONSE,
+    DOMAIN,
+    SERVICE_GET_HISTORY,
+    SERVICE_REFRESH_DEVICE_INFO,
+)
+from .coordinator import RenogyCoordinator
 
 # TODO List the platforms that you want to support.
 # For your initial PR, limit it to 1 platform.
@@ -28,81 +44,200 @@ PLATFORMS: list[Platform] = [Platform.SENSOR]
 
 _LOGGER = logging.getLogger(__name__)
 
-# address = "80:6F:B0:0F:BD:C1"
-address = None
+GET_HISTORY_SCHEMA = vol.Schema(
+    {
+        vol.Required("entity_id"): cv.entity_id,
+        vol.Optional("minutes", default=60): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=7 * 24 * 60)
+        ),
+        vol.Optional("resolution"): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    }
+)
+
+
+def parse_id_list(ids: str) -> list[int]:
+    """Turn a comma separated list of modbus IDs into ints."""
+    return [int(i) for i in str(ids).split(",") if i.strip()]
 
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Set up renogy from a config entry."""
-    global address
     hass.data.setdefault(DOMAIN, {})
 
-    print("starting up renogy")
-    # print(entry.data)
     address = entry.data.get("mac")
-    # print(address)
-
-    batteryListStr = entry.data.get("batteries")
-    batteryList = []
-    if "," in batteryListStr:
-        batteryList = [int(i) for i in batteryListStr.split(",")]
-    else:
-        batteryList.append(int(batteryListStr))
-
-    controllerListStr = entry.data.get("controllers")
-    controllerList = []
-    if "," in controllerListStr:
-        controllerList = [int(i) for i in controllerListStr.split(",")]
-    else:
-        controllerList.append(int(controllerListStr))
+    _LOGGER.debug("Starting up renogy %s", address)
+
+    batteryList = parse_id_list(entry.data.get("batteries"))
+    controllerList = parse_id_list(entry.data.get("controllers"))
 
     assert address is not None
     await close_stale_connections_by_address(address)
     # print("closed stale connections")
 
+    # Entities are set up from the stored topology even if the hub hasn't
+    # been seen yet, the coordinator keeps looking for it on every poll
     ble_device = bluetooth.async_ble_device_from_address(hass, address)
     # print("got a device")
-    if not ble_device:
-        # print("Couldn't connect to device, hopefully it's just gone out for the day...")
-        # return False
-        raise ConfigEntryNotReady(
-            f"Could not find Renogy device with address {address}"
-        )
-        # return None
 
-    async def _async_update_method() -> dict:
-        # else:
-        client = await establish_connection(BleakClient, ble_device, ble_device.address)
-        return await getStats(
-            client=client, batteryList=batteryList, controllerList=controllerList
-        )
-
-    coordinator = DataUpdateCoordinator(
+    coordinator = RenogyCoordinator(
         hass,
-        _LOGGER,
-        name=DOMAIN,
-        update_method=_async_update_method,
-        update_interval=timedelta(seconds=DEFAULT_SCAN_INTERVAL),
+        entry,
+        ble_device,
+        batteryList,
+        controllerList,
+        entry.options.get(CONF_SAMPLE_INTERVAL, DEFAULT_SAMPLE_INTERVAL),
+        entry.options.get(CONF_PRESENCE_TIMEOUT, DEFAULT_PRESENCE_TIMEOUT),
+        entry.options.get(CONF_WRITE_WITHOUT_RESPONSE, DEFAULT_WRITE_WITHOUT_RESPONSE),
+        entry.options.get(CONF_REQUEST_WINDOW, DEFAULT_REQUEST_WINDOW),
     )
 
-    await coordinator.async_config_entry_first_refresh()
+    async def _async_stop(event: Event) -> None:
+        await coordinator.session.close()
+
+    entry.async_on_unload(coordinator.session.close)
+    entry.async_on_unload(coordinator.async_track_presence())
+    entry.async_on_unload(coordinator.async_unregister)
+    entry.async_on_unload(
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _async_stop)
+    )
 
-    hass.data[DOMAIN][address] = coordinator
-    # TODO 1. Create API instance
-    # TODO 2. Validate the API connection (and authentication)
-    # TODO 3. Store an API object for your platforms to access
-    # hass.data[DOMAIN][entry.entry_id] = MyApi(...)
-    # hass.states.set(f"{DOMAIN}.world", "Mark")
+    hass.data[DOMAIN][entry.entry_id] = coordinator
+
+    # The hub itself, so batteries and controllers can sit behind it
+    dr.async_get(hass).async_get_or_create(
+        config_entry_id=entry.entry_id,
+        identifiers={(DOMAIN, address)},
+        connections={(dr.CONNECTION_BLUETOOTH, address)},
+        name=f"Renogy {entry.data.get('friendlyName')}",
+        manufacturer="Renogy",
+        model=coordinator.identity.get("hub", {}).get("model") or "BT-2",
+    )
+
+    async def _async_refresh_device_info(call: ServiceCall) -> None:
+        for hub in hass.data[DOMAIN].values():
+            hub.async_invalidate_identity()
+            await hub.async_request_refresh()
+
+    if not hass.services.has_service(DOMAIN, SERVICE_REFRESH_DEVICE_INFO):
+        hass.services.async_register(
+            DOMAIN, SERVICE_REFRESH_DEVICE_INFO, _async_refresh_device_info
+        )
+    if not hass.services.has_service(DOMAIN, SERVICE_GET_HISTORY):
+        hass.services.async_register(
+            DOMAIN,
+            SERVICE_GET_HISTORY,
+            _async_get_history,
+            schema=GET_HISTORY_SCHEMA,
+            supports_response=SupportsResponse.ONLY,
+        )
 
     await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
 
+    # Entities come from the stored topology with restored values, so the
+    # first poll (a connect plus reads of everything) needn't hold up startup
+    entry.async_create_background_task(
+        hass, coordinator.async_refresh(), f"{DOMAIN} first refresh {address}"
+    )
+
+    if coordinator.sampler is not None:
+        entry.async_create_background_task(
+            hass, coordinator.async_sample_loop(), f"{DOMAIN} sampling {address}"
+        )
+    entry.async_on_unload(entry.add_update_listener(_async_update_listener))
+
     return True
 
 
+async def _async_get_history(call: ServiceCall) -> ServiceResponse:
+    """Recent values of a sensor from memory, without touching the recorder."""
+    hass = call.hass
+    entity_id = call.data["entity_id"]
+    entity_entry = er.async_get(hass).async_get(entity_id)
+    if entity_entry is None or entity_entry.platform != DOMAIN:
+        raise ServiceValidationError(f"{entity_id} is not a Renogy sensor")
+    # Unique IDs are hub MAC, modbus ID and value name
+    hubAddress, deviceId, name = entity_entry.unique_id.split("_", 2)
+    coordinator = next(
+        (c for c in hass.data[DOMAIN].values() if c.address == hubAddress), None
+    )
+    if coordinator is None or not deviceId.isdigit():
+        raise ServiceValidationError(f"{entity_id} has no history")
+    now = time.time()
+    result = coordinator.history.query(
+        int(deviceId),
+        name,
+        now - call.data["minutes"] * 60,
+        now,
+        call.data.get("resolution"),
+    )
+    if result is None:
+        return {"entity_id": entity_id, "resolution": None, "points": []}
+    resolution, points = result
+    return {
+        "entity_id": entity_id,
+        "resolution": resolution,
+        # [bucket start (epoch seconds), mean, min, max]
+        "points": [
+            # Means pick up float noise from the division
+            [start, round(mean, 4), low, high]
+            for start, mean, low, high in points
+        ],
+    }
+
+
+async def _async_update_listener(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    """Reload when the options change."""
+    coordinator: RenogyCoordinator = hass.data[DOMAIN][entry.entry_id]
+    # Identity updates land here too, they don't need a reload
+    if entry.options != coordinator.options:
+        await hass.config_entries.async_reload(entry.entry_id)
+
+
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Unload a config entry."""
-    print(f"Unloading renogy {address}")
+    _LOGGER.debug("Unloading renogy %s", entry.data.get("mac"))
     if unload_ok := await hass.config_entries.async_unload_platforms(entry, PLATFORMS):
-        hass.data[DOMAIN].pop(address)
+        hass.data[DOMAIN].pop(entry.entry_id)
+        if not hass.data[DOMAIN]:
+            hass.services.async_remove(DOMAIN, SERVICE_REFRESH_DEVICE_INFO)
+            hass.services.async_remove(DOMAIN, SERVICE_GET_HISTORY)
 
     return unload_ok
+
+
+async def async_migrate_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
+    """Migrate an old config entry."""
+    _LOGGER.debug("Migrating renogy entry from version %s", entry.version)
+
+    if entry.version == 1:
+        # Unique IDs used to be just the modbus ID, which clashes as soon as
+        # there is more than one hub. Prefix them with the hub MAC.
+        mac = entry.data["mac"]
+
+        @callback
+        def _migrate_unique_id(
+            entity_entry: er.RegistryEntry,
+        ) -> dict[str, str] | None:
+            if entity_entry.unique_id.startswith(f"{mac}_"):
+                return None
+            return {"new_unique_id": f"{mac}_{entity_entry.unique_id}"}
+
+        await er.async_migrate_entries(hass, entry.entry_id, _migrate_unique_id)
+
+        device_registry = dr.async_get(hass)
+        for device in dr.async_entries_for_config_entry(
+            device_registry, entry.entry_id
+        ):
+            identifiers = {
+                (domain, f"{mac}_{identifier}")
+                if domain == DOMAIN and not str(identifier).startswith(f"{mac}_")
+                else (domain, identifier)
+                for domain, identifier in device.identifiers
+            }
+            device_registry.async_update_device(
+                device.id, new_identifiers=identifiers, new_connections=set()
+            )
+
+        hass.config_entries.async_update_entry(entry, version=2)
+
+    return True
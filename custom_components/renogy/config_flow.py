@@ -1,92 +1,114 @@
 """Config flow for renogy integration."""
 from __future__ import annotations
 
+import asyncio
 import logging
 from typing import Any
 
+from bleak import BleakError
 import voluptuous as vol
 
 from homeassistant import config_entries
+from homeassistant.components import bluetooth
 
 # from homeassistant.const import CONF_HOST
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.data_entry_flow import FlowResult
 from homeassistant.exceptions import HomeAssistantError
 
-from .const import DOMAIN
+from .const import (
+    CONF_PRESENCE_TIMEOUT,
+    CONF_REQUEST_WINDOW,
+    CONF_SAMPLE_INTERVAL,
+    CONF_WRITE_WITHOUT_RESPONSE,
+    DEFAULT_PRESENCE_TIMEOUT,
+    DEFAULT_REQUEST_WINDOW,
+    DEFAULT_SAMPLE_INTERVAL,
+    DEFAULT_WRITE_WITHOUT_RESPONSE,
+    DOMAIN,
+    MAX_REQUEST_WINDOW,
+    MAX_SAMPLE_INTERVAL,
+)
+from .renogy.device import discoverDevices, probeDevice
+from .renogy.session import RenogySession
 
 _LOGGER = logging.getLogger(__name__)
 
-# TODO adjust the data schema to the data that you need
 STEP_USER_DATA_SCHEMA = vol.Schema(
     {
         vol.Required("friendlyName"): str,
         vol.Required("mac"): str,
-        vol.Required("batteries"): str,
-        vol.Required("controllers"): str,
-        # vol.Required(CONF_CONTROLLERS): str,
+        # Leave both empty to find the devices on the hub automatically
+        vol.Optional("batteries", default=""): str,
+        vol.Optional("controllers", default=""): str,
     }
 )
 
 
-class PlaceholderHub:
-    """Placeholder class to make tests pass.
-
-    TODO Remove this placeholder class and replace with things from your PyPI package.
-    """
-
-    def __init__(self, mac: str, batteries: list) -> None:
-        """Initialize."""
-        self.mac = mac
-        self.batteries = batteries
-        print(f"mac in init: {self.mac}, {batteries}")
-
-    async def authenticate(self, username: str, password: str) -> bool:
-        """Test if we can authenticate with the host."""
-        return True
+def _parse_ids(ids: str) -> list[int]:
+    try:
+        return [int(i) for i in ids.split(",") if i.strip()]
+    except ValueError as err:
+        raise InvalidIds from err
 
 
 async def validate_input(hass: HomeAssistant, data: dict[str, Any]) -> dict[str, Any]:
     """Validate the user input allows us to connect.
 
     Data has the keys from STEP_USER_DATA_SCHEMA with values provided by the user.
+    Connects to the hub and either checks the IDs given answer, or if none
+    were given, discovers what is on the bus.
     """
-    # TODO validate the data can be used to set up a connection.
-
-    # If your PyPI package is not built with async, pass your methods
-    # to the executor:
-    # await hass.async_add_executor_job(
-    #     your_validate_func, data[CONF_USERNAME], data[CONF_PASSWORD]
-    # )
-    batteryIds = data.get("batteries")
-    if "," in batteryIds:
-        batteryIds = [int(i) for i in batteryIds.split(",")]
-
-    controllerIds = data.get("controllers")
-    if "," in batteryIds:
-        batteryIds = [int(i) for i in controllerIds.split(",")]
-
-    mac = data["mac"]
-    friendlyName = data["friendlyName"]
-    hub = PlaceholderHub(mac, batteryIds)
-    # print(f"Got mac {mac}, {batteryIds}")
-
-    # if not await hub.authenticate(data[CONF_USERNAME], data[CONF_PASSWORD]):
-    #     raise InvalidAuth
-
-    # If you cannot connect:
-    # throw CannotConnect
-    # If the authentication is wrong:
-    # InvalidAuth
+    batteryIds = _parse_ids(data.get("batteries", ""))
+    controllerIds = _parse_ids(data.get("controllers", ""))
+
+    ble_device = bluetooth.async_ble_device_from_address(hass, data["mac"])
+    if ble_device is None:
+        raise CannotConnect
+
+    session = RenogySession(ble_device, idle_timeout=None)
+    try:
+        async with session.acquire() as transport:
+            if batteryIds or controllerIds:
+                for deviceId, deviceType in [(b, "battery") for b in batteryIds] + [
+                    (c, "controller") for c in controllerIds
+                ]:
+                    found = await probeDevice(transport, deviceId)
+                    if found is None:
+                        raise DeviceNotFound
+                    if found != deviceType:
+                        raise WrongDeviceType
+            else:
+                topology = await discoverDevices(transport)
+                batteryIds = topology["batteries"]
+                controllerIds = topology["controllers"]
+    except (BleakError, asyncio.TimeoutError) as err:
+        raise CannotConnect from err
+    finally:
+        await session.close()
+
+    if not batteryIds and not controllerIds:
+        raise NoDevicesFound
 
     # Return info that you want to store in the config entry.
-    return {"title": friendlyName}
+    return {
+        "title": data["friendlyName"],
+        "batteries": ",".join(str(i) for i in batteryIds),
+        "controllers": ",".join(str(i) for i in controllerIds),
+    }
 
 
 class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     """Handle a config flow for renogy."""
 
-    VERSION = 1
+    VERSION = 2
+
+    @staticmethod
+    @callback
+    def async_get_options_flow(
+        config_entry: config_entries.ConfigEntry,
+    ) -> config_entries.OptionsFlow:
+        return OptionsFlowHandler(config_entry)
 
     async def async_step_user(
         self, user_input: dict[str, Any] | None = None
@@ -94,26 +116,103 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         """Handle the initial step."""
         errors: dict[str, str] = {}
         if user_input is not None:
+            await self.async_set_unique_id(user_input["mac"])
+            self._abort_if_unique_id_configured()
             try:
                 info = await validate_input(self.hass, user_input)
             except CannotConnect:
                 errors["base"] = "cannot_connect"
-            except InvalidAuth:
-                errors["base"] = "invalid_auth"
+            except InvalidIds:
+                errors["base"] = "invalid_ids"
+            except DeviceNotFound:
+                errors["base"] = "device_not_found"
+            except WrongDeviceType:
+                errors["base"] = "wrong_device_type"
+            except NoDevicesFound:
+                errors["base"] = "no_devices_found"
             except Exception:  # pylint: disable=broad-except
                 _LOGGER.exception("Unexpected exception")
                 errors["base"] = "unknown"
             else:
-                return self.async_create_entry(title=info["title"], data=user_input)
+                return self.async_create_entry(
+                    title=info["title"],
+                    data={
+                        **user_input,
+                        "batteries": info["batteries"],
+                        "controllers": info["controllers"],
+                    },
+                )
 
         return self.async_show_form(
             step_id="user", data_schema=STEP_USER_DATA_SCHEMA, errors=errors
         )
 
 
+class OptionsFlowHandler(config_entries.OptionsFlow):
+    """Handle options for a hub."""
+
+    def __init__(self, config_entry: config_entries.ConfigEntry) -> None:
+        """init."""
+        self._entry = config_entry
+
+    async def async_step_init(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+
+        return self.async_show_form(
+            step_id="init",
+            data_schema=vol.Schema(
+                {
+                    vol.Optional(
+                        CONF_SAMPLE_INTERVAL,
+                        default=self._entry.options.get(
+                            CONF_SAMPLE_INTERVAL, DEFAULT_SAMPLE_INTERVAL
+                        ),
+                    ): vol.All(
+                        vol.Coerce(int), vol.Range(min=0, max=MAX_SAMPLE_INTERVAL)
+                    ),
+                    vol.Optional(
+                        CONF_PRESENCE_TIMEOUT,
+                        default=self._entry.options.get(
+                            CONF_PRESENCE_TIMEOUT, DEFAULT_PRESENCE_TIMEOUT
+                        ),
+                    ): vol.All(vol.Coerce(int), vol.Range(min=0)),
+                    vol.Optional(
+                        CONF_WRITE_WITHOUT_RESPONSE,
+                        default=self._entry.options.get(
+                            CONF_WRITE_WITHOUT_RESPONSE, DEFAULT_WRITE_WITHOUT_RESPONSE
+                        ),
+                    ): bool,
+                    vol.Optional(
+                        CONF_REQUEST_WINDOW,
+                        default=self._entry.options.get(
+                            CONF_REQUEST_WINDOW, DEFAULT_REQUEST_WINDOW
+                        ),
+                    ): vol.All(
+                        vol.Coerce(int), vol.Range(min=1, max=MAX_REQUEST_WINDOW)
+                    ),
+                }
+            ),
+        )
+
+
 class CannotConnect(HomeAssistantError):
     """Error to indicate we cannot connect."""
 
 
-class InvalidAuth(HomeAssistantError):
-    """Error to indicate there is invalid auth."""
+class InvalidIds(HomeAssistantError):
+    """Error to indicate the device IDs couldn't be parsed."""
+
+
+class DeviceNotFound(HomeAssistantError):
+    """Error to indicate one of the given device IDs didn't answer."""
+
+
+class WrongDeviceType(HomeAssistantError):
+    """Error to indicate a battery ID is a controller or the other way round."""
+
+
+class NoDevicesFound(HomeAssistantError):
+    """Error to indicate discovery found nothing on the hub."""
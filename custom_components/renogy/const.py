@@ -2,7 +2,32 @@
 
 DOMAIN = "renogy"
 
-DEFAULT_SCAN_INTERVAL = 30
+DEFAULT_SCAN_INTERVAL = 10
+
+# Write a sensor's state at least this often (seconds) even if it hasn't moved
+DEADBAND_MAX_AGE = 300
+
+SERVICE_REFRESH_DEVICE_INFO = "refresh_device_info"
+SERVICE_GET_HISTORY = "get_history"
+
+# Seconds between high-rate samples of current and power, 0 turns it off
+CONF_SAMPLE_INTERVAL = "sample_interval"
+DEFAULT_SAMPLE_INTERVAL = 0
+MAX_SAMPLE_INTERVAL = 10
+
+# Stop polling a hub that has neither answered a poll nor been seen by Home
+# Assistant for this many seconds, 0 always polls
+CONF_PRESENCE_TIMEOUT = "presence_timeout"
+DEFAULT_PRESENCE_TIMEOUT = 300
+
+# Send requests without waiting for a write response when the hub allows it
+CONF_WRITE_WITHOUT_RESPONSE = "write_without_response"
+DEFAULT_WRITE_WITHOUT_RESPONSE = True
+
+# Requests to different devices on a hub that may be in flight at once
+CONF_REQUEST_WINDOW = "request_window"
+DEFAULT_REQUEST_WINDOW = 1
+MAX_REQUEST_WINDOW = 8
 
 # CONF_MAC = None
 # CONF_BATTERIES = None
@@ -0,0 +1,382 @@
+"""Data update coordinator for a Renogy BT-2 hub."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections.abc import Callable
+from contextlib import asynccontextmanager
+from datetime import timedelta
+
+from bleak import BleakError
+from bleak.backends.device import BLEDevice
+
+from homeassistant.components import bluetooth
+from homeassistant.components.bluetooth import (
+    BluetoothCallbackMatcher,
+    BluetoothScanningMode,
+)
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers import device_registry as dr
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
+
+from .const import DEFAULT_SCAN_INTERVAL, DOMAIN
+from .renogy.arbiter import ARBITER
+from .renogy.device import (
+    DeviceHealth,
+    PollSchedule,
+    getStats,
+    readHubModel,
+    readIdentity,
+    warmFrameCache,
+)
+from .renogy.history import History
+from .renogy.sampling import Sampler
+from .renogy.session import RenogySession
+from .renogy.stats import CYCLE, QUEUE, LatencyStats
+from .renogy.transport import ModbusError
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def adapter_source(ble_device: BLEDevice) -> str:
+    """The adapter or proxy Home Assistant reaches a device through."""
+    details = ble_device.details
+    if isinstance(details, dict) and details.get("source"):
+        return details["source"]
+    return "default"
+
+
+class RenogyCoordinator(DataUpdateCoordinator[dict]):
+    """Polls every device behind one BT-2 hub.
+
+    Everything a hub needs between polls (BLE session, refresh schedule)
+    lives here, so each config entry is independent of the others.
+    """
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        entry: ConfigEntry,
+        ble_device: BLEDevice | None,
+        batteryList: list,
+        controllerList: list,
+        sample_interval: float = 0,
+        presence_timeout: float = 0,
+        write_without_response: bool = True,
+        request_window: int = 1,
+    ) -> None:
+        """init.
+
+        A sample_interval above 0 samples current and power that often
+        between polls, see async_sample_loop. A presence_timeout above 0
+        pauses polling once the hub has neither answered a poll nor been
+        seen by Home Assistant for that long, see async_track_presence.
+        """
+        self.entry = entry
+        # Options this coordinator was built with, a change means a reload
+        self.options = dict(entry.options)
+        self.address = entry.data["mac"]
+        super().__init__(
+            hass,
+            _LOGGER,
+            name=f"{DOMAIN} {self.address}",
+            update_interval=timedelta(seconds=DEFAULT_SCAN_INTERVAL),
+        )
+        self.batteryList = batteryList
+        self.controllerList = controllerList
+        self.stats = LatencyStats()
+        self.session = RenogySession(
+            ble_device,
+            stats=self.stats,
+            write_without_response=write_without_response,
+            window=request_window,
+        )
+        # Hubs on the same adapter queue for it and are polled staggered
+        self.arbiter = ARBITER
+        self.adapter = adapter_source(ble_device) if ble_device else "default"
+        self.arbiter.register(self.adapter, self.address)
+        # Polls and samples of this hub queue here before asking the arbiter,
+        # so a hub never holds more than one of its adapter's slots
+        self._connection_lock = asyncio.Lock()
+        self.schedule = PollSchedule()
+        self.health = DeviceHealth()
+        self.sample_interval = sample_interval
+        self.presence_timeout = presence_timeout
+        # Last successful poll or sample, counting set up as one
+        self.last_seen = time.monotonic()
+        self.paused = False
+        self.sampler = (
+            Sampler(batteryList, controllerList) if sample_interval > 0 else None
+        )
+        # Recent values at a few resolutions, for the get_history service
+        self.history = History()
+        # Model, serial, firmware etc. keyed by "hub" or the modbus ID as a
+        # string, kept in the config entry so it survives restarts
+        self.identity: dict[str, dict] = dict(entry.data.get("identity", {}))
+        self._identityConnects = None
+        # Devices whose identity couldn't be read on this connection, read
+        # once they are answering again
+        self._identityMissing: set[int] = set()
+        self._apply_cell_counts()
+        warmFrameCache(batteryList, controllerList, schedule=self.schedule)
+
+    def _apply_cell_counts(self) -> None:
+        """Lay battery reads out for the cell counts we know about."""
+        for battery in self.batteryList:
+            cellCount = self.identity.get(str(battery), {}).get("cellCount")
+            if cellCount:
+                self.schedule.setCellCount(battery, cellCount)
+
+    @callback
+    def async_unregister(self) -> None:
+        """Stop counting this hub against its adapter."""
+        self.arbiter.unregister(self.address)
+
+    def _set_ble_device(self, ble_device: BLEDevice) -> None:
+        self.session.set_ble_device(ble_device)
+        adapter = adapter_source(ble_device)
+        if adapter != self.adapter:
+            _LOGGER.debug("%s moved to adapter %s", self.address, adapter)
+            self.adapter = adapter
+            self.arbiter.register(adapter, self.address)
+
+    @asynccontextmanager
+    async def _async_connection(self):
+        """Wait for the hub, then the adapter, and hand out the transport."""
+        if self.session.ble_device is None:
+            raise BleakError(
+                f"Could not find Renogy device with address {self.address}"
+            )
+        async with self._connection_lock:
+            adapter = self.adapter
+            with self.stats.measure(QUEUE):
+                await self.arbiter.acquire(adapter)
+            try:
+                async with self.session.acquire() as transport:
+                    yield transport
+            finally:
+                self.arbiter.release(adapter)
+
+    @property
+    def present(self) -> bool:
+        """Is the hub around, so worth connecting to.
+
+        A hub stops advertising while we are connected to it, so an open
+        session or a recent successful poll count as much as Home
+        Assistant still having it on its list of present devices.
+        """
+        return (
+            not self.presence_timeout
+            or self.session.is_connected
+            or time.monotonic() - self.last_seen < self.presence_timeout
+            or bluetooth.async_address_present(
+                self.hass, self.address, connectable=False
+            )
+        )
+
+    @callback
+    def async_track_presence(self) -> Callable[[], None]:
+        """Resume polling when the hub reappears, returns the unsubscribe.
+
+        Home Assistant only calls back for an advertisement it hasn't seen
+        before, which includes the first one after the hub went missing.
+        """
+        return bluetooth.async_register_callback(
+            self.hass,
+            self._async_advertisement,
+            BluetoothCallbackMatcher(address=self.address, connectable=False),
+            BluetoothScanningMode.PASSIVE,
+        )
+
+    @callback
+    def _async_advertisement(
+        self,
+        service_info: bluetooth.BluetoothServiceInfoBleak,
+        change: bluetooth.BluetoothChange,
+    ) -> None:
+        if not self.paused:
+            return
+        _LOGGER.info("%s is back in range, resuming polling", self.address)
+        self.paused = False
+        self.update_interval = timedelta(seconds=DEFAULT_SCAN_INTERVAL)
+        self.hass.async_create_task(self.async_request_refresh())
+
+    async def _async_pause(self) -> None:
+        """Stop polling until the hub advertises again."""
+        _LOGGER.info(
+            "%s not seen or polled for %ss, pausing polling until it is back",
+            self.address,
+            self.presence_timeout,
+        )
+        self.paused = True
+        # Nothing is scheduled while paused, the next advertisement restarts it
+        self.update_interval = None
+        await self.session.close()
+
+    @callback
+    def async_invalidate_identity(self) -> None:
+        """Re-read device identity on the next poll."""
+        self._identityConnects = None
+
+    async def _async_read_identity(self, transport, deviceIds=None) -> None:
+        """Read the identity of the hub and its devices, or just deviceIds.
+
+        Devices the breaker has given up on, or that time out, are left
+        for a later poll so they can't hold this one up.
+        """
+        identity = {key: dict(value) for key, value in self.identity.items()}
+        if deviceIds is None:
+            identity.setdefault("hub", {})["model"] = await readHubModel(transport)
+            self._identityConnects = self.session.connects
+            self._identityMissing = set()
+        for deviceId, deviceType in [(b, "battery") for b in self.batteryList] + [
+            (c, "controller") for c in self.controllerList
+        ]:
+            if deviceIds is not None and deviceId not in deviceIds:
+                continue
+            if self.health.is_tripped(deviceId):
+                self._identityMissing.add(deviceId)
+                continue
+            try:
+                fields = await readIdentity(transport, deviceId, deviceType)
+            except asyncio.TimeoutError as err:
+                _LOGGER.debug("No identity from %s: %s", deviceId, err)
+                self._identityMissing.add(deviceId)
+                continue
+            self._identityMissing.discard(deviceId)
+            identity.setdefault(str(deviceId), {}).update(fields)
+        if identity == self.identity:
+            return
+        self.identity = identity
+        self._apply_cell_counts()
+        self.hass.config_entries.async_update_entry(
+            self.entry, data={**self.entry.data, "identity": identity}
+        )
+        self._async_update_device_registry()
+
+    @callback
+    def _async_update_device_registry(self) -> None:
+        """Push identity to devices that were registered before it was known."""
+        device_registry = dr.async_get(self.hass)
+        for key, identity in self.identity.items():
+            identifier = self.address if key == "hub" else f"{self.address}_{key}"
+            device = device_registry.async_get_device(
+                identifiers={(DOMAIN, identifier)}
+            )
+            if device is None:
+                continue
+            changes = {}
+            if identity.get("model"):
+                changes["model"] = identity["model"]
+            if identity.get("firmware"):
+                changes["sw_version"] = identity["firmware"]
+            if identity.get("serial") is not None:
+                changes["serial_number"] = str(identity["serial"])
+            if changes:
+                device_registry.async_update_device(device.id, **changes)
+
+    @callback
+    def _async_device_updated(self, deviceId: int, deviceDict: dict) -> None:
+        """Publish one device's results without waiting for the whole cycle."""
+        # Devices not polled yet show their restored values meanwhile
+        self.data = {**(self.data or {}), deviceId: deviceDict}
+        self.async_update_listeners()
+
+    async def _async_update_data(self) -> dict:
+        if not self.present:
+            if not self.paused:
+                await self._async_pause()
+            raise UpdateFailed(f"Renogy device {self.address} is out of range")
+        if ble_device := bluetooth.async_ble_device_from_address(
+            self.hass, self.address
+        ):
+            self._set_ble_device(ble_device)
+        start = time.monotonic()
+        try:
+            with self.stats.measure(CYCLE):
+                data = await self._async_poll()
+        except (BleakError, asyncio.TimeoutError, ModbusError) as err:
+            raise UpdateFailed(
+                f"Error polling Renogy device {self.address}: {err}"
+            ) from err
+        finally:
+            # Next poll is timed from the start of this one, nudged so hubs
+            # on the same adapter take turns
+            self.update_interval = timedelta(
+                seconds=max(
+                    0,
+                    self.arbiter.next_interval(
+                        self.adapter, self.address, DEFAULT_SCAN_INTERVAL, start
+                    )
+                    - (time.monotonic() - start),
+                )
+            )
+        # At least one device answered
+        self.last_seen = time.monotonic()
+        return data
+
+    async def _async_poll(self) -> dict:
+        # Only what was read this cycle goes into history, values merged on
+        # from earlier polls aren't new samples
+        fresh: dict[int, dict] = {}
+        async with self._async_connection() as transport:
+            if self._identityConnects != self.session.connects:
+                # New connection, or asked to refresh
+                await self._async_read_identity(transport)
+            elif answering := [
+                deviceId
+                for deviceId in self._identityMissing
+                if (self.data or {}).get(deviceId, {}).get("available")
+            ]:
+                await self._async_read_identity(transport, answering)
+            data = await getStats(
+                transport=transport,
+                batteryList=self.batteryList,
+                controllerList=self.controllerList,
+                schedule=self.schedule,
+                snapshot=self.data,
+                onDevice=self._async_device_updated,
+                health=self.health,
+                onRead=fresh.__setitem__,
+            )
+        if self.sampler is not None:
+            for deviceId, values in self.sampler.publish().items():
+                if deviceId in data:
+                    data[deviceId] = {**data[deviceId], **values}
+                    fresh[deviceId] = {**fresh.get(deviceId, {}), **values}
+        now = time.time()
+        for deviceId, values in fresh.items():
+            self.history.record(deviceId, values, now)
+        return data
+
+    async def async_sample_loop(self) -> None:
+        """Sample current and power every sample_interval until cancelled.
+
+        Samples share the poll's connection, which they keep open, and are
+        only published to Home Assistant with the next poll.
+        """
+        while True:
+            start = time.monotonic()
+            if not self.present:
+                await asyncio.sleep(self.sample_interval)
+                continue
+            skip = [
+                deviceId
+                for deviceId in self.batteryList + self.controllerList
+                if self.health.is_tripped(deviceId)
+            ]
+            try:
+                async with self._async_connection() as transport:
+                    samples = await self.sampler.sample(transport, skip)
+                if samples:
+                    self.last_seen = time.monotonic()
+                now = time.time()
+                for deviceId, values in samples.items():
+                    self.history.record(deviceId, values, now)
+            except (BleakError, asyncio.TimeoutError, ModbusError) as err:
+                _LOGGER.debug("Error sampling %s: %s", self.address, err)
+            await asyncio.sleep(
+                max(0, self.sample_interval - (time.monotonic() - start))
+            )
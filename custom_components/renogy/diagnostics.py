@@ -0,0 +1,53 @@
+"""Diagnostics support for renogy."""
+from __future__ import annotations
+
+import time
+from typing import Any
+
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+from .coordinator import RenogyCoordinator
+
+# Diagnostics end up attached to public issues. "mac" is the hub's address,
+# "serial" is in each device's identity and "hubs" lists hub addresses.
+TO_REDACT = {"mac", "serial", "hubs"}
+
+
+async def async_get_config_entry_diagnostics(
+    hass: HomeAssistant, entry: ConfigEntry
+) -> dict[str, Any]:
+    """Return diagnostics for a config entry."""
+    coordinator: RenogyCoordinator = hass.data[DOMAIN][entry.entry_id]
+    session = coordinator.session
+    transport = session.transport
+    return {
+        "entry": async_redact_data(entry.data, TO_REDACT),
+        "connection": {
+            "connected": session.is_connected,
+            "connects": session.connects,
+            "crc_errors": transport.decoder.crc_errors if transport else None,
+            "write_without_response": transport.write_without_response
+            if transport
+            else None,
+            # In flight requests allowed, 1 after falling back
+            "window": transport.window if transport else None,
+            "window_fallbacks": transport.fallbacks if transport else None,
+        },
+        # Milliseconds, per step of the poll, device and block read
+        "latency": coordinator.stats.as_dict(),
+        # Devices that have failed recently, and when they'll be retried
+        "health": coordinator.health.as_dict(time.monotonic()),
+        "adapter": coordinator.adapter,
+        # Every hub in Home Assistant, by the adapter it is polled through
+        "adapters": async_redact_data(coordinator.arbiter.as_dict(), TO_REDACT),
+        "presence": {
+            "seconds_since_poll": round(time.monotonic() - coordinator.last_seen, 1),
+            "present": coordinator.present,
+            "paused": coordinator.paused,
+        },
+        "last_update_success": coordinator.last_update_success,
+        "data": coordinator.data,
+    }
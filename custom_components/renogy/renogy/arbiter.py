@@ -0,0 +1,124 @@
+"""Shares Bluetooth adapters fairly between every hub polled through them.
+
+Each adapter (a local controller or a proxy) gets a number of slots. A hub
+takes a slot for the length of a poll cycle or sample, and hubs waiting for
+a busy adapter are served first come first served instead of piling up
+connection retries. The arbiter also staggers hubs on the same adapter
+across the poll interval, with a little jitter, so their timers don't keep
+lining up.
+"""
+import asyncio
+import random
+from collections import deque
+
+# Poll cycles one adapter runs at the same time. Connecting to several
+# devices at once is what makes adapters and proxies stall.
+DEFAULT_ADAPTER_SLOTS = 2
+# Poll intervals are randomly stretched or shrunk by up to this fraction
+JITTER = 0.05
+# Largest share of an interval a hub's phase is moved by in one cycle
+MAX_PHASE_SHIFT = 0.25
+
+
+class _Adapter:
+    def __init__(self, slots: int) -> None:
+        self.slots = slots
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.hubs: set[str] = set()
+
+
+class AdapterArbiter:
+    """Per-adapter FIFO of poll cycles, and when each hub should poll next."""
+
+    def __init__(
+        self, slots: int = DEFAULT_ADAPTER_SLOTS, adapterSlots: dict | None = None
+    ) -> None:
+        """init.
+
+        adapterSlots overrides the number of slots for particular adapters.
+        """
+        self.slots = slots
+        self.adapterSlots = adapterSlots or {}
+        self._adapters: dict[str, _Adapter] = {}
+        self._random = random.Random()
+
+    def _adapter(self, adapter: str) -> _Adapter:
+        state = self._adapters.get(adapter)
+        if state is None:
+            state = self._adapters[adapter] = _Adapter(
+                self.adapterSlots.get(adapter, self.slots)
+            )
+        return state
+
+    def register(self, adapter: str, hub: str) -> None:
+        """Count a hub as polling through an adapter, for staggering."""
+        for state in self._adapters.values():
+            state.hubs.discard(hub)
+        self._adapter(adapter).hubs.add(hub)
+
+    def unregister(self, hub: str) -> None:
+        for state in self._adapters.values():
+            state.hubs.discard(hub)
+
+    async def acquire(self, adapter: str) -> None:
+        """Wait for a free slot on an adapter, in the order hubs asked."""
+        state = self._adapter(adapter)
+        if state.active < state.slots and not state.waiters:
+            state.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        state.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in state.waiters:
+                state.waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                # The slot was handed to us just as we were cancelled
+                self.release(adapter)
+            raise
+
+    def release(self, adapter: str) -> None:
+        """Give a slot back, straight to the longest waiting hub if any."""
+        state = self._adapter(adapter)
+        while state.waiters:
+            waiter = state.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        state.active -= 1
+
+    def next_interval(
+        self, adapter: str, hub: str, interval: float, now: float
+    ) -> float:
+        """Seconds until a hub should poll again.
+
+        Hubs sharing an adapter are spread evenly across the interval. Each
+        cycle moves a hub part of the way towards its slot in the spread,
+        then adds jitter so nothing stays in lockstep.
+        """
+        hubs = sorted(self._adapter(adapter).hubs)
+        delay = interval
+        if hub in hubs and len(hubs) > 1:
+            target = hubs.index(hub) * interval / len(hubs)
+            offset = (target - now % interval + interval / 2) % interval
+            offset -= interval / 2
+            limit = interval * MAX_PHASE_SHIFT
+            delay += max(-limit, min(limit, offset))
+        return delay + self._random.uniform(-JITTER, JITTER) * interval
+
+    def as_dict(self) -> dict:
+        return {
+            adapter: {
+                "slots": state.slots,
+                "active": state.active,
+                "waiting": len(state.waiters),
+                "hubs": sorted(state.hubs),
+            }
+            for adapter, state in self._adapters.items()
+        }
+
+
+# One arbiter for every hub in the process, like the frame cache
+ARBITER = AdapterArbiter()
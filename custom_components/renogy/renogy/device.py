@@ -1,257 +1,454 @@
 import asyncio
-from bleak import BleakClient, BleakError, BleakGATTCharacteristic
-from bleak.backends.device import BLEDevice
-from bleak_retry_connector import establish_connection
+import logging
 import time
-from .Utils import bytes_to_int, int_to_bytes, crc16_modbus
-import binascii
-
-WRITE_SERVICE_UUID = "0000ffd1-0000-1000-8000-00805f9b34fb"
-NOTIFY_SERVICE_UUID = "0000fff1-0000-1000-8000-00805f9b34fb"
-
-waiting = False
-waitStart = 0
-waitTimeout = 10
-gotReturnVal = False
-returnVal = None
-
-batteryRegisterInfo = {
-    "cell1Voltage": {
-        "description": "Cell 1 voltage",
-        "register": 5001,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "cell2Voltage": {
-        "description": "Cell 2 voltage",
-        "register": 5002,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "cell3Voltage": {
-        "description": "Cell 3 voltage",
-        "register": 5003,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "cell4Voltage": {
-        "description": "Cell 4 voltage",
-        "register": 5004,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "cell1Temperature": {
-        "description": "Cell 1 Temperature",
-        "register": 5018,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "cell2Temperature": {
-        "description": "Cell 2 Temperature",
-        "register": 5019,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "cell3Temperature": {
-        "description": "Cell 3 Temperature",
-        "register": 5020,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "cell4Temperature": {
-        "description": "Cell 4 Temperature",
-        "register": 5021,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "remainingCapacity": {
-        "description": "Remain capacity",
-        "register": 5044,
-        "wordSize": 2,
-        "multiplier": 0.001,
-    },
-    "totalCapacity": {
-        "description": "Total capacity",
-        "register": 5046,
-        "wordSize": 2,
-        "multiplier": 0.001,
-    },
-    "current": {
-        "description": "Current",
-        "register": 5042,
-        "wordSize": 1,
-        "multiplier": 0.01,
-    },
-    "voltage": {
-        "description": "Voltage",
-        "register": 5043,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "cycleCount": {
-        "description": "Cycle count",
-        "register": 5048,
-        "wordSize": 1,
-        "multiplier": 1,
-    },
-    "dischargeCurentLimit": {
-        "description": "Discharge Current Limit",
-        "register": 5052,
-        "wordSize": 1,
-        "multiplier": 0.01,
-    },
-    "chargeCurentLimit": {
-        "description": "Charge Current Limit",
-        "register": 5051,
-        "wordSize": 1,
-        "multiplier": 0.01,
-    },
+from collections.abc import Callable
+from .registers import (
+    CELL_COUNT_REGISTER,
+    DEFAULT_CELL_COUNT,
+    MAX_BLOCK_GAP,
+    MAX_BLOCK_WORDS,
+    READ_PLANS,
+    REFRESH_FAST,
+    REFRESH_NORMAL,
+    REFRESH_SLOW,
+    REFRESH_STATIC,
+    REGISTERS_BY_NAME,
+    Block,
+    compilePlans,
+    decodeBlock,
+    deviceRegisters,
+    layoutKey,
+)
+from .transport import FRAME_CACHE, ModbusError, ModbusTransport
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds between reads of each refresh class, 0 reads it every poll and
+# None only reads it once
+REFRESH_INTERVALS = {
+    REFRESH_FAST: 0,
+    REFRESH_NORMAL: 30,
+    REFRESH_SLOW: 300,
+    REFRESH_STATIC: None,
+}
+# Poll timers drift a little, treat a class as due this many seconds early
+REFRESH_SLACK = 1.0
+
+
+class PollSchedule:
+    """Tracks which refresh classes are due for each device.
+
+    Block read plans are compiled up front for every device layout and set
+    of due classes, so a cycle only reads what is due without re-planning.
+    A battery's layout depends on its cell count, which is set once known.
+    """
+
+    def __init__(
+        self,
+        maxGap: int = MAX_BLOCK_GAP,
+        maxWords: int = MAX_BLOCK_WORDS,
+        intervals: dict = REFRESH_INTERVALS,
+        slack: float = REFRESH_SLACK,
+    ) -> None:
+        """init."""
+        self.maxGap = maxGap
+        self.maxWords = maxWords
+        self.intervals = intervals
+        self.slack = slack
+        self._lastRead: dict[tuple[int, str], float] = {}
+        self._cellCounts: dict[int, int] = {}
+        if (maxGap, maxWords) == (MAX_BLOCK_GAP, MAX_BLOCK_WORDS):
+            self._plans = READ_PLANS
+        else:
+            self._plans = {}
+
+    def due(self, deviceId: int, now: float) -> frozenset:
+        """Refresh classes that need reading for a device this cycle."""
+        due = []
+        for tier, interval in self.intervals.items():
+            last = self._lastRead.get((deviceId, tier))
+            if last is None or (
+                interval is not None and now - last + self.slack >= interval
+            ):
+                due.append(tier)
+        return frozenset(due)
+
+    def mark(self, deviceId: int, tiers: frozenset, now: float) -> None:
+        for tier in tiers:
+            self._lastRead[(deviceId, tier)] = now
+
+    def forget(self, deviceId: int) -> None:
+        """Make every register of a device due again."""
+        for tier in self.intervals:
+            self._lastRead.pop((deviceId, tier), None)
+
+    def cellCount(self, deviceId: int) -> int | None:
+        return self._cellCounts.get(deviceId)
+
+    def setCellCount(self, deviceId: int, cellCount: int) -> None:
+        if self._cellCounts.get(deviceId) == cellCount:
+            return
+        self._cellCounts[deviceId] = cellCount
+        # Read the new layout in full next time
+        self.forget(deviceId)
+
+    def _layoutPlans(self, deviceType: str, deviceId: int | None) -> dict:
+        key = layoutKey(deviceType, self._cellCounts.get(deviceId))
+        plans = self._plans.get(key)
+        if plans is None:
+            plans = self._plans[key] = compilePlans(
+                deviceRegisters(*key), self.maxGap, self.maxWords
+            )
+        return plans
+
+    def plan(
+        self, deviceType: str, tiers: frozenset, deviceId: int | None = None
+    ) -> tuple[Block, ...]:
+        """Block reads covering a device's registers in the given classes."""
+        if not tiers:
+            return ()
+        return self._layoutPlans(deviceType, deviceId)[tiers]
+
+    def plans(self, deviceType: str, deviceId: int | None = None):
+        """Every plan the schedule can ask for, one per combination of classes."""
+        return self._layoutPlans(deviceType, deviceId).values()
+
+
+def warmFrameCache(
+    batteryList: list,
+    controllerList: list,
+    maxGap: int = MAX_BLOCK_GAP,
+    maxWords: int = MAX_BLOCK_WORDS,
+    schedule: PollSchedule | None = None,
+) -> None:
+    """Build every request frame getStats will send, so polls don't have to."""
+    if schedule is None:
+        schedule = PollSchedule(maxGap, maxWords)
+    for battery in batteryList:
+        for blocks in schedule.plans("battery", battery):
+            FRAME_CACHE.warm([battery], blocks)
+    for blocks in schedule.plans("controller"):
+        FRAME_CACHE.warm(controllerList, blocks)
+
+
+MODEL_NBR_UUID = "00002a24-0000-1000-8000-00805f9b34fb"
+
+# Registers that don't change for the life of a device, read once per
+# connection rather than every poll
+batteryIdentityInfo = {
+    "cellCount": {"register": CELL_COUNT_REGISTER, "wordSize": 1, "format": "int"},
+    "serial": {"register": 5110, "wordSize": 8, "format": "ascii"},
+    "model": {"register": 5122, "wordSize": 8, "format": "ascii"},
+    "firmware": {"register": 5130, "wordSize": 8, "format": "ascii"},
+}
+
+controllerIdentityInfo = {
+    "model": {"register": 0x0C, "wordSize": 8, "format": "ascii"},
+    "firmware": {"register": 0x14, "wordSize": 2, "format": "version"},
+    "serial": {"register": 0x18, "wordSize": 2, "format": "int"},
 }
 
-# batteryList = [48, 49]
-
-# controllerList = [97]
-
-controllerRegisterInfo = {
-    "alternatorVoltage": {
-        "description": "Alternator Voltage",
-        "register": 0x104,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "alternatorCurrent": {
-        "description": "Alternator Current",
-        "register": 0x105,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "alternatorPower": {
-        "description": "Alternator Power",
-        "register": 0x106,
-        "wordSize": 1,
-        "multiplier": 1,
-    },
-    "solarVoltage": {
-        "description": "Solar Voltage",
-        "register": 0x107,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "solarCurrent": {
-        "description": "Solar Current",
-        "register": 0x108,
-        "wordSize": 1,
-        "multiplier": 0.1,
-    },
-    "solarPower": {
-        "description": "Solar Power",
-        "register": 0x109,
-        "wordSize": 1,
-        "multiplier": 1,
-    },
+IDENTITY_INFO = {
+    "battery": batteryIdentityInfo,
+    "controller": controllerIdentityInfo,
 }
 
 
-def notification_handler(sender: BleakGATTCharacteristic, data: bytearray):
-    global returnVal
-    global gotReturnVal
-    # print("Wooo got something")
-    id = data[0]
-    mode = data[1]
-    length = data[2]
-    start = 3
-    end = 3 + length
-    val = int.from_bytes(data[start:end], byteorder="big", signed=True)
-    # print(data[3:7].hex())
-    # print(id, mode, length, val/1000)
-    # print(data.hex())
-    # print(f"{sender}: {data}")
-    returnVal = val
-    # print(returnVal)
-    gotReturnVal = True
-    # exit(0)
+def decodeIdentityField(payload: bytes | memoryview, fieldFormat: str):
+    if fieldFormat == "ascii":
+        return bytes(payload).decode("ascii", errors="ignore").strip("\x00 ")
+    if fieldFormat == "version":
+        return "V{}.{}.{}".format(*bytes(payload)[1:4])
+    return int.from_bytes(payload, byteorder="big")
+
+
+async def readHubModel(transport: ModbusTransport) -> str:
+    """Model number the BT-2 reports over GATT."""
+    model_number = await transport.client.read_gatt_char(MODEL_NBR_UUID)
+    return bytes(model_number).decode("ascii", errors="ignore").strip("\x00 ")
+
+
+async def readIdentity(
+    transport: ModbusTransport, deviceId: int, deviceType: str
+) -> dict:
+    """Read a device's static identity (model, serial, firmware...).
+
+    Fields are read one at a time and skipped if the device doesn't have
+    them, so an older device still gives us whatever it does support. A
+    timeout means the device isn't answering at all and is raised straight
+    away rather than waited out once per field.
+    """
+    identity = {}
+    for name, v in IDENTITY_INFO[deviceType].items():
+        try:
+            payload = await transport.read_registers(
+                deviceId, v["register"], v["wordSize"]
+            )
+        except ModbusError as err:
+            _LOGGER.debug("No %s from %s %s: %s", name, deviceType, deviceId, err)
+            continue
+        identity[name] = decodeIdentityField(payload, v["format"])
+    return identity
+
+
+# Modbus IDs tried by discovery. Renogy batteries default to 48 and up and
+# DC-DC chargers to 97, the low IDs cover controllers set up by hand.
+DISCOVERY_IDS = list(range(1, 17)) + list(range(48, 64)) + list(range(96, 112))
+# Seconds to wait for each probe, an absent ID never answers at all
+DISCOVERY_TIMEOUT = 0.5
+# Registers every device of a type answers, used to tell the types apart
+BATTERY_PROBE_REGISTER = REGISTERS_BY_NAME["voltage"].register
+CONTROLLER_PROBE_REGISTER = REGISTERS_BY_NAME["solarVoltage"].register
+PROBE_REGISTERS = {
+    "battery": BATTERY_PROBE_REGISTER,
+    "controller": CONTROLLER_PROBE_REGISTER,
+}
+
+# Consecutive failed polls before a device is skipped
+BREAKER_THRESHOLD = 3
+# Seconds before the first re-probe of a skipped device, doubling after
+# every failed re-probe up to BREAKER_MAX_DELAY
+BREAKER_BASE_DELAY = 30
+BREAKER_MAX_DELAY = 900
+
+
+async def probeDevice(
+    transport: ModbusTransport, deviceId: int, timeout: float = DISCOVERY_TIMEOUT
+) -> str | None:
+    """Work out whether a Modbus ID is a battery, a controller or nothing.
+
+    A device that answers with a Modbus exception is there but isn't the
+    type being probed for, so the other type is tried next. An ID that
+    doesn't answer at all has nothing behind it and isn't probed again.
+    """
+    for deviceType, register in (
+        ("battery", BATTERY_PROBE_REGISTER),
+        ("controller", CONTROLLER_PROBE_REGISTER),
+    ):
+        try:
+            await transport.read_registers(deviceId, register, 1, timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        except ModbusError:
+            continue
+        return deviceType
+    return None
+
+
+async def discoverDevices(
+    transport: ModbusTransport,
+    deviceIds: list = DISCOVERY_IDS,
+    timeout: float = DISCOVERY_TIMEOUT,
+) -> dict:
+    """Probe a range of Modbus IDs and sort the ones that answer by type.
+
+    Returns {"batteries": [...], "controllers": [...]}. Probes go through the
+    transport one by one, which queues them, so they can be fired off
+    together once the transport allows more than one request in flight.
+    """
+    results = await asyncio.gather(
+        *(probeDevice(transport, deviceId, timeout) for deviceId in deviceIds)
+    )
+    topology = {"batteries": [], "controllers": []}
+    for deviceId, deviceType in zip(deviceIds, results):
+        if deviceType == "battery":
+            topology["batteries"].append(deviceId)
+        elif deviceType == "controller":
+            topology["controllers"].append(deviceId)
+    _LOGGER.debug("Discovered %s", topology)
+    return topology
+
+
+async def readCellCount(
+    transport: ModbusTransport, deviceId: int, schedule: PollSchedule
+) -> int:
+    """Ask a battery how many cells it has and lay its reads out to match."""
+    try:
+        payload = await transport.read_registers(deviceId, CELL_COUNT_REGISTER, 1)
+    except ModbusError as err:
+        # Older BMS firmware, stick with the default layout
+        _LOGGER.debug("No cell count from battery %s: %s", deviceId, err)
+        cellCount = DEFAULT_CELL_COUNT
+    else:
+        cellCount = int.from_bytes(payload, byteorder="big") or DEFAULT_CELL_COUNT
+    schedule.setCellCount(deviceId, cellCount)
+    return cellCount
+
+
+async def readDevice(
+    transport: ModbusTransport,
+    deviceId: int,
+    deviceType: str,
+    schedule: PollSchedule,
+    previous: dict,
+    now: float,
+    onRead: Callable[[int, dict], None] | None = None,
+) -> dict:
+    """Read the due registers of one device and merge them over its last values.
+
+    onRead is called with just the values read this time.
+    """
+    deviceDict = dict(previous)
+    deviceDict.update({"address": deviceId, "type": deviceType})
+    if deviceType == "battery" and schedule.cellCount(deviceId) is None:
+        await readCellCount(transport, deviceId, schedule)
+    tiers = schedule.due(deviceId, now)
+    values = {}
+    for start, wordCount, fields in schedule.plan(deviceType, tiers, deviceId):
+        payload = await transport.read_registers(deviceId, start, wordCount)
+        decodeBlock(payload, fields, values)
+    schedule.mark(deviceId, tiers, now)
+    deviceDict.update(values)
+    if onRead is not None:
+        onRead(deviceId, values)
+    deviceDict["available"] = True
+    return deviceDict
+
+
+class DeviceHealth:
+    """Circuit breaker per device.
+
+    After BREAKER_THRESHOLD failures in a row a device is skipped, then
+    re-probed with one short read on an exponential backoff until it
+    answers again. Healthy devices are always polled.
+    """
+
+    def __init__(
+        self,
+        threshold: int = BREAKER_THRESHOLD,
+        baseDelay: float = BREAKER_BASE_DELAY,
+        maxDelay: float = BREAKER_MAX_DELAY,
+    ) -> None:
+        """init."""
+        self.threshold = threshold
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self._failures: dict[int, int] = {}
+        self._retryAt: dict[int, float] = {}
+
+    def is_tripped(self, deviceId: int) -> bool:
+        return self._failures.get(deviceId, 0) >= self.threshold
+
+    def should_poll(self, deviceId: int, now: float) -> bool:
+        return not self.is_tripped(deviceId) or now >= self._retryAt[deviceId]
+
+    def success(self, deviceId: int) -> None:
+        if self.is_tripped(deviceId):
+            _LOGGER.info("Device %s is answering again", deviceId)
+        self._failures.pop(deviceId, None)
+        self._retryAt.pop(deviceId, None)
+
+    def failure(self, deviceId: int, now: float) -> None:
+        failures = self._failures[deviceId] = self._failures.get(deviceId, 0) + 1
+        if failures < self.threshold:
+            return
+        delay = min(self.maxDelay, self.baseDelay * 2 ** (failures - self.threshold))
+        if failures == self.threshold:
+            _LOGGER.info(
+                "Device %s failed %s polls in a row, retrying in %ss",
+                deviceId,
+                failures,
+                delay,
+            )
+        self._retryAt[deviceId] = now + delay
+
+    def as_dict(self, now: float) -> dict:
+        return {
+            deviceId: {
+                "failures": failures,
+                "tripped": self.is_tripped(deviceId),
+                "retry_in": round(self._retryAt[deviceId] - now, 1)
+                if deviceId in self._retryAt
+                else None,
+            }
+            for deviceId, failures in self._failures.items()
+        }
 
 
 async def getStats(
-    client: BleakClient, batteryList: list, controllerList: list
+    transport: ModbusTransport,
+    batteryList: list,
+    controllerList: list,
+    maxGap: int = MAX_BLOCK_GAP,
+    maxWords: int = MAX_BLOCK_WORDS,
+    schedule: PollSchedule | None = None,
+    snapshot: dict | None = None,
+    onDevice: Callable[[int, dict], None] | None = None,
+    health: DeviceHealth | None = None,
+    onRead: Callable[[int, dict], None] | None = None,
 ) -> dict:
-    # print("In device.py!!", client)
-    # print(f"Connected: {client.is_connected}")
+    """Read whatever is due and merge it into the previous snapshot.
+
+    Without a schedule every register is read. onDevice is called with each
+    device's results as soon as they are in, onRead with only the values
+    actually read for it this cycle. A device that doesn't answer is
+    kept with its last values and "available" set to False, the error is
+    only raised if no device answered at all. With health, devices that
+    keep failing are skipped and only re-probed now and then.
+    """
+    # print(f"Connected: {transport.client.is_connected}")
     # print(batteryList)
+    if schedule is None:
+        schedule = PollSchedule(maxGap, maxWords)
+    if snapshot is None:
+        snapshot = {}
 
-    def create_generic_read_request(device_id, function, regAddr, readWrd):
-        data = None
-        if regAddr != None and readWrd != None:
-            data = []
-            data.append(device_id)
-            data.append(function)
-            data.append(int_to_bytes(regAddr, 0))
-            data.append(int_to_bytes(regAddr, 1))
-            data.append(int_to_bytes(readWrd, 0))
-            data.append(int_to_bytes(readWrd, 1))
-
-            crc = crc16_modbus(bytes(data))
-            data.append(crc[0])
-            data.append(crc[1])
-            # logging.debug("{} {} => {}".format("create_request_payload", regAddr, data))
-        return data
-
-    async def get_modbus_value(device_id, regAddr, wordLen, multiplier):
-        global returnVal
-        global gotReturnVal
-        writeData = bytes(create_generic_read_request(device_id, 3, regAddr, wordLen))
-        waitStart = time.time()
-        gotReturnVal = False
-        # print(f"About to send: {writeData.hex()}")
-        await client.write_gatt_char(WRITE_SERVICE_UUID, writeData, response=True)
-        # while (waitStart < time.time() - waitTimeout) and gotReturnVal == False:
-        while gotReturnVal == False:
-            # print(waitStart, time.time() - waitTimeout, time.time(), waitTimeout, returnVal, gotReturnVal)
-            # print("Waiting")
-            await asyncio.sleep(0.01)
-        #     time.sleep(1)
-        # print(f"Got: {returnVal} for dev: {device_id}, reg: {regAddr}")
-        return "%.3f" % (returnVal * multiplier)
-
-    await client.start_notify(NOTIFY_SERVICE_UUID, notification_handler)
-    # print("To send:", bytes(writeData).hex())
-    MODEL_NBR_UUID = "00002a24-0000-1000-8000-00805f9b34fb"
-    model_number = await client.read_gatt_char(MODEL_NBR_UUID)
-    # print("Model Number: {0}".format("".join(map(chr, model_number))))
-
-    READ_UUID = "0000ffd4-0000-1000-8000-00805f9b34fb"
-    # READ_UUID = NOTIFY_SERVICE_UUID
-    # ba = await client.read_gatt_char(READ_UUID)
-    # print(await get_modbus_value(48, 5044, 2))
-    # print(await get_modbus_value(49, 5044, 2))
+    devices = [(b, "battery") for b in batteryList] + [
+        (c, "controller") for c in controllerList
+    ]
+    now = time.monotonic()
     retList = {}
-    for battery in batteryList:
-        batteryDict = {"address": battery, "type": "battery"}
-        # print(f"Battery: {battery}")
-        for k, v in batteryRegisterInfo.items():
-            # print(k, v.get("register"))
-            modbusValue = await get_modbus_value(
-                battery,
-                v.get("register"),
-                v.get("wordSize"),
-                v.get("multiplier", 1),
-            )
-            # print(f"{k}: {modbusValue}")
-            batteryDict[k] = modbusValue
-        retList[battery] = batteryDict
-
-    for controller in controllerList:
-        controllerDict = {"address": controller, "type": "controller"}
-
-        # print(f"Controller: {controller}")
-        for k, v in controllerRegisterInfo.items():
-            # print(k, v.get("register"))
-            modbusValue = await get_modbus_value(
-                controller, v.get("register"), v.get("wordSize"), v.get("multiplier", 1)
+    lastError = None
+
+    async def pollDevice(deviceId: int, deviceType: str) -> None:
+        nonlocal lastError
+        previous = snapshot.get(deviceId, {})
+        deviceDict = dict(previous)
+        deviceDict.update({"address": deviceId, "type": deviceType, "available": False})
+        if health is not None and not health.should_poll(deviceId, now):
+            retList[deviceId] = deviceDict
+            return
+        try:
+            if health is not None and health.is_tripped(deviceId):
+                # Cheap check before spending a full read on it
+                await transport.read_registers(
+                    deviceId,
+                    PROBE_REGISTERS[deviceType],
+                    1,
+                    timeout=DISCOVERY_TIMEOUT,
+                )
+            deviceDict = await readDevice(
+                transport, deviceId, deviceType, schedule, previous, now, onRead
             )
-            # print(f"{k}: {modbusValue}")
-            controllerDict[k] = modbusValue
-        retList[controller] = controllerDict
+        except (asyncio.TimeoutError, ModbusError) as err:
+            _LOGGER.debug("Failed to read %s %s: %s", deviceType, deviceId, err)
+            lastError = err
+            if health is not None:
+                health.failure(deviceId, now)
+        else:
+            if health is not None:
+                health.success(deviceId)
+        retList[deviceId] = deviceDict
+        if onDevice is not None:
+            onDevice(deviceId, deviceDict)
+
+    if transport.window > 1:
+        # Each device's reads stay in order, but different devices'
+        # requests share the transport's window
+        tasks = [asyncio.create_task(pollDevice(*device)) for device in devices]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # The link is gone, don't let the others carry on without it
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        retList = {deviceId: retList[deviceId] for deviceId, _ in devices}
+    else:
+        for device in devices:
+            await pollDevice(*device)
+    if lastError is not None and not any(d["available"] for d in retList.values()):
+        raise lastError
     # print(retList)
-    await client.disconnect()
     return retList
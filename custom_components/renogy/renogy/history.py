@@ -0,0 +1,125 @@
+"""Recent values of every register, kept in memory at a few resolutions.
+
+Each register gets one fixed-size ring per tier. A tier groups samples into
+buckets of its resolution and keeps the mean, min and max of each, so a
+1 s tier holds the raw samples and coarser tiers cover longer spans in the
+same space. Storage is preallocated arrays, nothing grows once a register
+has been seen.
+"""
+from array import array
+
+# (bucket seconds, buckets kept) per tier, finest first: 10 minutes of
+# 1 s samples, 4 hours of minutes and 2 days of quarter hours
+DEFAULT_TIERS = ((1, 600), (60, 240), (900, 192))
+# Numeric values that aren't readings
+NOT_RECORDED = frozenset({"address"})
+
+
+class Tier:
+    """Ring of time-aligned buckets for one register."""
+
+    def __init__(self, resolution: float, capacity: int) -> None:
+        """init."""
+        self.resolution = resolution
+        self.capacity = capacity
+        self._start = array("d", bytes(8 * capacity))
+        self._count = array("I", bytes(4 * capacity))
+        self._sum = array("d", bytes(8 * capacity))
+        self._min = array("d", bytes(8 * capacity))
+        self._max = array("d", bytes(8 * capacity))
+        # Index of the newest bucket and how many are filled
+        self._head = -1
+        self._size = 0
+
+    def add(self, timestamp: float, value: float) -> None:
+        start = timestamp - timestamp % self.resolution
+        head = self._head
+        if self._size and self._start[head] == start:
+            self._count[head] += 1
+            self._sum[head] += value
+            if value < self._min[head]:
+                self._min[head] = value
+            if value > self._max[head]:
+                self._max[head] = value
+            return
+        if self._size and start < self._start[head]:
+            # Clock went backwards, don't scramble the ring
+            return
+        head = self._head = (head + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+        self._start[head] = start
+        self._count[head] = 1
+        self._sum[head] = value
+        self._min[head] = value
+        self._max[head] = value
+
+    @property
+    def span(self) -> float:
+        """Seconds of history the tier can hold."""
+        return self.resolution * self.capacity
+
+    def query(self, since: float = 0) -> list[list]:
+        """[start, mean, min, max] per bucket from since on, oldest first."""
+        points = []
+        for i in range(self._size - 1, -1, -1):
+            index = (self._head - i) % self.capacity
+            start = self._start[index]
+            if start + self.resolution <= since:
+                continue
+            points.append(
+                [
+                    start,
+                    self._sum[index] / self._count[index],
+                    self._min[index],
+                    self._max[index],
+                ]
+            )
+        return points
+
+
+class History:
+    """Tiers for every (device, register) that has been recorded."""
+
+    def __init__(self, tiers=DEFAULT_TIERS) -> None:
+        """init."""
+        self.tiers = tiers
+        self._series: dict[tuple[int, str], tuple[Tier, ...]] = {}
+
+    def record(self, deviceId: int, values: dict, timestamp: float) -> None:
+        """Add every numeric value of a device at timestamp (epoch seconds)."""
+        for name, value in values.items():
+            if (
+                name in NOT_RECORDED
+                or isinstance(value, bool)
+                or not isinstance(value, (int, float))
+            ):
+                continue
+            series = self._series.get((deviceId, name))
+            if series is None:
+                series = self._series[(deviceId, name)] = tuple(
+                    Tier(resolution, capacity) for resolution, capacity in self.tiers
+                )
+            for tier in series:
+                tier.add(timestamp, value)
+
+    def query(
+        self,
+        deviceId: int,
+        name: str,
+        since: float,
+        now: float,
+        resolution: float | None = None,
+    ) -> tuple[float, list[list]] | None:
+        """(resolution, points) for a register since a point in time.
+
+        Without a resolution the finest tier that reaches back to since is
+        used, or the coarsest if none do. None if the register is unknown.
+        """
+        series = self._series.get((deviceId, name))
+        if series is None:
+            return None
+        if resolution is not None:
+            tier = min(series, key=lambda t: abs(t.resolution - resolution))
+        else:
+            tier = next((t for t in series if now - t.span <= since), series[-1])
+        return tier.resolution, tier.query(since)
@@ -0,0 +1,636 @@
+"""Register schema shared by the polling engine and the sensor platform.
+
+Every register is declared once below. At import the schema is compiled
+into tuple-backed descriptors and a block read plan for every combination
+of refresh classes, so a poll only walks precomputed tuples.
+"""
+import itertools
+import math
+from typing import NamedTuple
+
+# Registers closer together than this are fetched in one read, the gap
+# words are read and thrown away
+MAX_BLOCK_GAP = 4
+# Largest number of words we'll ask for in a single function 3 read, enough
+# for a controller's whole dynamic block (0x100-0x122) in one go
+MAX_BLOCK_WORDS = 40
+
+# How often a register needs refreshing, declared per register below
+REFRESH_FAST = "fast"
+REFRESH_NORMAL = "normal"
+REFRESH_SLOW = "slow"
+REFRESH_STATIC = "static"
+REFRESH_CLASSES = (REFRESH_FAST, REFRESH_NORMAL, REFRESH_SLOW, REFRESH_STATIC)
+
+# Units, device classes and state classes are the Home Assistant string
+# values, kept as plain strings so this module doesn't need HA
+VOLT = "V"
+AMPERE = "A"
+WATT = "W"
+AMPERE_HOUR = "Ah"
+CELSIUS = "°C"
+PERCENT = "%"
+WATT_HOUR = "Wh"
+KILO_WATT_HOUR = "kWh"
+DAYS = "d"
+
+
+class Register(NamedTuple):
+    """One value read from a device."""
+
+    name: str
+    register: int
+    words: int = 1
+    scale: float = 1
+    unit: str | None = None
+    deviceClass: str | None = None
+    stateClass: str | None = "measurement"
+    refresh: str = REFRESH_NORMAL
+    signed: bool = True
+    # Decimal places of the scaled value, None works it out from scale
+    precision: int | None = None
+    description: str = ""
+    # (lowest bit, width) of a value packed into part of a register. A
+    # signed one has its top bit as a sign flag, the way Renogy packs them
+    bits: tuple[int, int] | None = None
+    # Names for the values of a state register, indexed by raw value
+    options: tuple[str, ...] | None = None
+
+
+class Field(NamedTuple):
+    """Where a register sits in a block read response, in bytes."""
+
+    name: str
+    start: int
+    end: int
+    signed: bool
+    scale: float
+    precision: int | None
+    bits: tuple[int, int] | None
+    options: tuple[str, ...] | None
+
+
+class Block(NamedTuple):
+    """One function 3 read and the fields decoded out of it."""
+
+    start: int
+    words: int
+    fields: tuple[Field, ...]
+
+
+# The BMS reports how many cells it has at 5000 and exposes up to 16 cell
+# voltages and temperatures in two runs straight after it
+CELL_COUNT_REGISTER = 5000
+CELL_VOLTAGE_REGISTER = 5001
+CELL_TEMPERATURE_REGISTER = 5018
+MAX_CELLS = 16
+# Cells a battery is assumed to have until it tells us otherwise
+DEFAULT_CELL_COUNT = 4
+
+CELL_VOLTAGE_REGISTERS = tuple(
+    Register(
+        f"cell{n}Voltage",
+        CELL_VOLTAGE_REGISTER + n - 1,
+        scale=0.1,
+        unit=VOLT,
+        deviceClass="voltage",
+        description=f"Cell {n} voltage",
+    )
+    for n in range(1, MAX_CELLS + 1)
+)
+
+CELL_TEMPERATURE_REGISTERS = tuple(
+    Register(
+        f"cell{n}Temperature",
+        CELL_TEMPERATURE_REGISTER + n - 1,
+        scale=0.1,
+        unit=CELSIUS,
+        deviceClass="temperature",
+        refresh=REFRESH_SLOW,
+        description=f"Cell {n} Temperature",
+    )
+    for n in range(1, MAX_CELLS + 1)
+)
+
+# Everything on a battery apart from the per-cell registers
+BATTERY_PACK_REGISTERS = (
+    Register(
+        "current",
+        5042,
+        scale=0.01,
+        unit=AMPERE,
+        deviceClass="current",
+        refresh=REFRESH_FAST,
+        description="Current",
+    ),
+    Register(
+        "voltage",
+        5043,
+        scale=0.1,
+        unit=VOLT,
+        deviceClass="voltage",
+        refresh=REFRESH_FAST,
+        description="Voltage",
+    ),
+    Register(
+        "remainingCapacity",
+        5044,
+        words=2,
+        scale=0.001,
+        unit=AMPERE_HOUR,
+        description="Remain capacity",
+    ),
+    Register(
+        "totalCapacity",
+        5046,
+        words=2,
+        scale=0.001,
+        unit=AMPERE_HOUR,
+        refresh=REFRESH_SLOW,
+        description="Total capacity",
+    ),
+    Register(
+        "cycleCount",
+        5048,
+        stateClass="total_increasing",
+        refresh=REFRESH_SLOW,
+        description="Cycle count",
+    ),
+    Register(
+        "chargeCurentLimit",
+        5051,
+        scale=0.01,
+        unit=AMPERE,
+        deviceClass="current",
+        refresh=REFRESH_SLOW,
+        description="Charge Current Limit",
+    ),
+    Register(
+        "dischargeCurentLimit",
+        5052,
+        scale=0.01,
+        unit=AMPERE,
+        deviceClass="current",
+        refresh=REFRESH_SLOW,
+        description="Discharge Current Limit",
+    ),
+)
+
+CHARGING_STATES = (
+    "deactivated",
+    "activated",
+    "mppt",
+    "equalizing",
+    "boost",
+    "floating",
+    "current_limiting",
+)
+LOAD_STATES = ("off", "on")
+
+# The controller's dynamic block, 0x100-0x122. All of it is fast so a poll
+# fetches the lot in one read.
+CONTROLLER_REGISTERS = (
+    Register(
+        "batterySoc",
+        0x100,
+        unit=PERCENT,
+        deviceClass="battery",
+        refresh=REFRESH_FAST,
+        description="Battery SOC",
+    ),
+    Register(
+        "batteryVoltage",
+        0x101,
+        scale=0.1,
+        unit=VOLT,
+        deviceClass="voltage",
+        refresh=REFRESH_FAST,
+        description="Battery Voltage",
+    ),
+    Register(
+        "chargingCurrent",
+        0x102,
+        scale=0.01,
+        unit=AMPERE,
+        deviceClass="current",
+        refresh=REFRESH_FAST,
+        description="Charging Current",
+    ),
+    Register(
+        "controllerTemperature",
+        0x103,
+        unit=CELSIUS,
+        deviceClass="temperature",
+        refresh=REFRESH_FAST,
+        description="Controller Temperature",
+        bits=(8, 8),
+    ),
+    Register(
+        "batteryTemperature",
+        0x103,
+        unit=CELSIUS,
+        deviceClass="temperature",
+        refresh=REFRESH_FAST,
+        description="Battery Temperature",
+        bits=(0, 8),
+    ),
+    Register(
+        "alternatorVoltage",
+        0x104,
+        scale=0.1,
+        unit=VOLT,
+        deviceClass="voltage",
+        refresh=REFRESH_FAST,
+        description="Alternator Voltage",
+    ),
+    Register(
+        "alternatorCurrent",
+        0x105,
+        scale=0.1,
+        unit=AMPERE,
+        deviceClass="current",
+        refresh=REFRESH_FAST,
+        description="Alternator Current",
+    ),
+    Register(
+        "alternatorPower",
+        0x106,
+        unit=WATT,
+        deviceClass="power",
+        refresh=REFRESH_FAST,
+        description="Alternator Power",
+    ),
+    Register(
+        "solarVoltage",
+        0x107,
+        scale=0.1,
+        unit=VOLT,
+        deviceClass="voltage",
+        refresh=REFRESH_FAST,
+        description="Solar Voltage",
+    ),
+    Register(
+        "solarCurrent",
+        0x108,
+        scale=0.1,
+        unit=AMPERE,
+        deviceClass="current",
+        refresh=REFRESH_FAST,
+        description="Solar Current",
+    ),
+    Register(
+        "solarPower",
+        0x109,
+        unit=WATT,
+        deviceClass="power",
+        refresh=REFRESH_FAST,
+        description="Solar Power",
+    ),
+    Register(
+        "batteryMinVoltageToday",
+        0x10B,
+        scale=0.1,
+        unit=VOLT,
+        deviceClass="voltage",
+        refresh=REFRESH_FAST,
+        description="Battery Min Voltage Today",
+    ),
+    Register(
+        "batteryMaxVoltageToday",
+        0x10C,
+        scale=0.1,
+        unit=VOLT,
+        deviceClass="voltage",
+        refresh=REFRESH_FAST,
+        description="Battery Max Voltage Today",
+    ),
+    Register(
+        "maxChargingCurrentToday",
+        0x10D,
+        scale=0.01,
+        unit=AMPERE,
+        deviceClass="current",
+        refresh=REFRESH_FAST,
+        description="Max Charging Current Today",
+    ),
+    Register(
+        "maxDischargingCurrentToday",
+        0x10E,
+        scale=0.01,
+        unit=AMPERE,
+        deviceClass="current",
+        refresh=REFRESH_FAST,
+        description="Max Discharging Current Today",
+    ),
+    Register(
+        "maxChargingPowerToday",
+        0x10F,
+        unit=WATT,
+        deviceClass="power",
+        refresh=REFRESH_FAST,
+        description="Max Charging Power Today",
+    ),
+    Register(
+        "maxDischargingPowerToday",
+        0x110,
+        unit=WATT,
+        deviceClass="power",
+        refresh=REFRESH_FAST,
+        description="Max Discharging Power Today",
+    ),
+    Register(
+        "chargingAmpHoursToday",
+        0x111,
+        unit=AMPERE_HOUR,
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Charging Ah Today",
+    ),
+    Register(
+        "dischargingAmpHoursToday",
+        0x112,
+        unit=AMPERE_HOUR,
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Discharging Ah Today",
+    ),
+    Register(
+        "powerGenerationToday",
+        0x113,
+        unit=WATT_HOUR,
+        deviceClass="energy",
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Energy Generated Today",
+    ),
+    Register(
+        "powerConsumptionToday",
+        0x114,
+        unit=WATT_HOUR,
+        deviceClass="energy",
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Energy Consumed Today",
+    ),
+    Register(
+        "operatingDays",
+        0x115,
+        unit=DAYS,
+        deviceClass="duration",
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Operating Days",
+    ),
+    Register(
+        "batteryOverDischarges",
+        0x116,
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Battery Over-discharges",
+    ),
+    Register(
+        "batteryFullCharges",
+        0x117,
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Battery Full Charges",
+    ),
+    Register(
+        "totalChargingAmpHours",
+        0x118,
+        words=2,
+        unit=AMPERE_HOUR,
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Total Charging Ah",
+    ),
+    Register(
+        "totalDischargingAmpHours",
+        0x11A,
+        words=2,
+        unit=AMPERE_HOUR,
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Total Discharging Ah",
+    ),
+    Register(
+        "totalPowerGeneration",
+        0x11C,
+        words=2,
+        scale=0.001,
+        unit=KILO_WATT_HOUR,
+        deviceClass="energy",
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Total Energy Generated",
+    ),
+    Register(
+        "totalPowerConsumption",
+        0x11E,
+        words=2,
+        scale=0.001,
+        unit=KILO_WATT_HOUR,
+        deviceClass="energy",
+        stateClass="total_increasing",
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Total Energy Consumed",
+    ),
+    Register(
+        "loadState",
+        0x120,
+        deviceClass="enum",
+        stateClass=None,
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Load State",
+        bits=(15, 1),
+        options=LOAD_STATES,
+    ),
+    Register(
+        "chargingState",
+        0x120,
+        deviceClass="enum",
+        stateClass=None,
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Charging State",
+        bits=(0, 8),
+        options=CHARGING_STATES,
+    ),
+    Register(
+        "faultCodes",
+        0x121,
+        words=2,
+        stateClass=None,
+        refresh=REFRESH_FAST,
+        signed=False,
+        description="Fault Codes",
+    ),
+)
+
+
+def batteryRegisters(cellCount: int = DEFAULT_CELL_COUNT) -> tuple[Register, ...]:
+    """The registers of a battery with this many cells."""
+    cellCount = max(1, min(MAX_CELLS, cellCount))
+    return (
+        CELL_VOLTAGE_REGISTERS[:cellCount]
+        + CELL_TEMPERATURE_REGISTERS[:cellCount]
+        + BATTERY_PACK_REGISTERS
+    )
+
+
+def compileRegister(r: Register) -> Register:
+    """Fill in anything the schema left to be worked out."""
+    if r.precision is None and r.options is None:
+        r = r._replace(precision=max(0, -math.floor(math.log10(r.scale))))
+    return r
+
+
+def planBlockReads(
+    registers, maxGap: int = MAX_BLOCK_GAP, maxWords: int = MAX_BLOCK_WORDS
+) -> tuple[Block, ...]:
+    """Group registers into as few block reads as possible.
+
+    A run of back to back registers (e.g. all the cell voltages) is kept
+    in one read where it fits, rather than topping up the previous block
+    and spilling the rest of the run into another.
+    """
+    blocks = []
+    start = None
+    end = None
+    members = []
+
+    def close():
+        fields = tuple(
+            Field(
+                r.name,
+                (r.register - start) * 2,
+                (r.register - start + r.words) * 2,
+                r.signed,
+                r.scale,
+                r.precision,
+                r.bits,
+                r.options,
+            )
+            for r in members
+        )
+        blocks.append(Block(start, end - start, fields))
+
+    runs = []
+    for r in sorted(registers, key=lambda r: r.register):
+        if runs and r.register <= runs[-1][-1].register + runs[-1][-1].words:
+            runs[-1].append(r)
+        else:
+            runs.append([r])
+
+    for run in runs:
+        runEnd = max(r.register + r.words for r in run)
+        if start is not None and (
+            run[0].register - end > maxGap or runEnd - start > maxWords
+        ):
+            close()
+            start = None
+        for r in run:
+            if start is not None and r.register + r.words - start > maxWords:
+                # Run is too long for one read on its own
+                close()
+                start = None
+            if start is None:
+                start = r.register
+                end = r.register
+                members = []
+            members.append(r)
+            end = max(end, r.register + r.words)
+    if start is not None:
+        close()
+    return tuple(blocks)
+
+
+def compilePlans(
+    registers, maxGap: int = MAX_BLOCK_GAP, maxWords: int = MAX_BLOCK_WORDS
+) -> dict[frozenset, tuple[Block, ...]]:
+    """Block read plan for every combination of refresh classes."""
+    plans = {}
+    for size in range(1, len(REFRESH_CLASSES) + 1):
+        for tiers in itertools.combinations(REFRESH_CLASSES, size):
+            tiers = frozenset(tiers)
+            plans[tiers] = planBlockReads(
+                [r for r in registers if r.refresh in tiers], maxGap, maxWords
+            )
+    return plans
+
+
+def decodeBlock(payload, fields: tuple[Field, ...], values: dict | None = None) -> dict:
+    """Decode every field of a block read response into values."""
+    if values is None:
+        values = {}
+    for name, start, end, signed, scale, precision, bits, options in fields:
+        if bits is None:
+            val = int.from_bytes(payload[start:end], byteorder="big", signed=signed)
+        else:
+            shift, width = bits
+            val = int.from_bytes(payload[start:end], byteorder="big") >> shift
+            val &= (1 << width) - 1
+            if signed and val >> (width - 1):
+                val = -(val & ((1 << (width - 1)) - 1))
+        if options is not None:
+            values[name] = options[val] if val < len(options) else None
+        elif precision:
+            values[name] = round(val * scale, precision)
+        else:
+            values[name] = int(val * scale)
+    return values
+
+
+CELL_VOLTAGE_REGISTERS = tuple(compileRegister(r) for r in CELL_VOLTAGE_REGISTERS)
+CELL_TEMPERATURE_REGISTERS = tuple(
+    compileRegister(r) for r in CELL_TEMPERATURE_REGISTERS
+)
+BATTERY_PACK_REGISTERS = tuple(compileRegister(r) for r in BATTERY_PACK_REGISTERS)
+CONTROLLER_REGISTERS = tuple(compileRegister(r) for r in CONTROLLER_REGISTERS)
+# Every register a battery can have, whatever its cell count
+BATTERY_REGISTERS = batteryRegisters(MAX_CELLS)
+
+DEVICE_REGISTERS = {
+    "battery": BATTERY_REGISTERS,
+    "controller": CONTROLLER_REGISTERS,
+}
+REGISTERS_BY_NAME = {
+    r.name: r for registers in DEVICE_REGISTERS.values() for r in registers
+}
+
+
+def deviceRegisters(deviceType: str, cellCount: int | None = None):
+    """The registers to poll on a device, cellCount only matters for batteries."""
+    if deviceType == "battery":
+        return batteryRegisters(cellCount or DEFAULT_CELL_COUNT)
+    return DEVICE_REGISTERS[deviceType]
+
+
+def layoutKey(deviceType: str, cellCount: int | None = None) -> tuple:
+    """What a read plan depends on besides the refresh classes."""
+    if deviceType == "battery":
+        return (deviceType, max(1, min(MAX_CELLS, cellCount or DEFAULT_CELL_COUNT)))
+    return (deviceType, None)
+
+
+# Plans for the default block limits and every layout a device can have,
+# shared by every hub
+READ_PLANS = {
+    layoutKey(deviceType, cellCount): compilePlans(
+        deviceRegisters(deviceType, cellCount)
+    )
+    for deviceType, cellCount in [("controller", None)]
+    + [("battery", n) for n in range(1, MAX_CELLS + 1)]
+}
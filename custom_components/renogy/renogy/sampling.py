@@ -0,0 +1,224 @@
+"""High-rate sampling of a few fast moving values between polls.
+
+A handful of registers are read every second or two over the open
+connection. Each sample updates min/max/mean for the current interval and
+running Ah/Wh totals integrated with the trapezoidal rule, which are
+handed to Home Assistant at the normal poll interval instead of writing a
+state per sample.
+"""
+import asyncio
+import logging
+import time
+from typing import NamedTuple
+
+from .registers import (
+    AMPERE_HOUR,
+    DEVICE_REGISTERS,
+    WATT_HOUR,
+    Block,
+    decodeBlock,
+    planBlockReads,
+)
+from .transport import ModbusError, ModbusTransport
+
+_LOGGER = logging.getLogger(__name__)
+
+# Registers read on every sample, per device type
+SAMPLED_REGISTERS = {
+    "battery": ("current", "voltage"),
+    "controller": ("solarPower", "alternatorPower"),
+}
+# Statistics published for every sampled register
+SAMPLE_STATS = ("min", "max", "mean")
+# Don't integrate across a gap longer than this many seconds, the value
+# could have done anything while we weren't looking
+MAX_INTEGRATION_GAP = 30
+
+
+class Integral(NamedTuple):
+    """A running total integrated from sampled values."""
+
+    name: str
+    deviceType: str
+    # Multiplied together to give the hourly rate being integrated
+    sources: tuple[str, ...]
+    # 1 only totals a positive rate, -1 only the size of a negative one
+    direction: int
+    unit: str
+    deviceClass: str | None
+    description: str
+
+
+INTEGRALS = (
+    Integral("ampHoursIn", "battery", ("current",), 1, AMPERE_HOUR, None, "Charged Ah"),
+    Integral(
+        "ampHoursOut", "battery", ("current",), -1, AMPERE_HOUR, None, "Discharged Ah"
+    ),
+    Integral(
+        "energyIn",
+        "battery",
+        ("current", "voltage"),
+        1,
+        WATT_HOUR,
+        "energy",
+        "Charged Energy",
+    ),
+    Integral(
+        "energyOut",
+        "battery",
+        ("current", "voltage"),
+        -1,
+        WATT_HOUR,
+        "energy",
+        "Discharged Energy",
+    ),
+    Integral(
+        "solarEnergy",
+        "controller",
+        ("solarPower",),
+        1,
+        WATT_HOUR,
+        "energy",
+        "Solar Energy",
+    ),
+    Integral(
+        "alternatorEnergy",
+        "controller",
+        ("alternatorPower",),
+        1,
+        WATT_HOUR,
+        "energy",
+        "Alternator Energy",
+    ),
+)
+
+# Block reads covering the sampled registers of each device type
+SAMPLE_PLANS: dict[str, tuple[Block, ...]] = {
+    deviceType: planBlockReads(
+        [r for r in DEVICE_REGISTERS[deviceType] if r.name in names]
+    )
+    for deviceType, names in SAMPLED_REGISTERS.items()
+}
+
+
+def statKey(name: str, stat: str) -> str:
+    """Key a statistic of a sampled register is published under."""
+    return f"{name}{stat.capitalize()}"
+
+
+def rate(integral: Integral, values: dict) -> float:
+    value = 1.0
+    for source in integral.sources:
+        value *= values[source]
+    return max(0.0, value * integral.direction)
+
+
+class DeviceSampler:
+    """Statistics and running totals for one device."""
+
+    def __init__(self, deviceType: str) -> None:
+        """init."""
+        self.deviceType = deviceType
+        self.names = SAMPLED_REGISTERS[deviceType]
+        self.integrals = tuple(i for i in INTEGRALS if i.deviceType == deviceType)
+        self.totals = {i.name: 0.0 for i in self.integrals}
+        self.samples = 0
+        self._seeded: set[str] = set()
+        self._last: tuple[float, dict] | None = None
+        self._window: dict[str, list] = {}
+
+    def add(self, now: float, values: dict) -> None:
+        self.samples += 1
+        for name in self.names:
+            value = values[name]
+            window = self._window.get(name)
+            if window is None:
+                self._window[name] = [1, value, value, value]
+            else:
+                window[0] += 1
+                window[1] += value
+                window[2] = min(window[2], value)
+                window[3] = max(window[3], value)
+        if self._last is not None:
+            lastTime, lastValues = self._last
+            elapsed = now - lastTime
+            if 0 < elapsed <= MAX_INTEGRATION_GAP:
+                hours = elapsed / 3600
+                for integral in self.integrals:
+                    self.totals[integral.name] += (
+                        (rate(integral, lastValues) + rate(integral, values))
+                        / 2
+                        * hours
+                    )
+        self._last = (now, values)
+
+    def seed(self, name: str, total: float) -> None:
+        """Carry a running total on from before a restart, once."""
+        if name not in self.totals or name in self._seeded:
+            return
+        self._seeded.add(name)
+        self.totals[name] += total
+
+    def publish(self) -> dict:
+        """Totals, and statistics since the last publish.
+
+        Statistics of a register that wasn't sampled since are None, rather
+        than the last interval's carried forward.
+        """
+        values = {name: round(total, 3) for name, total in self.totals.items()}
+        for name in self.names:
+            window = self._window.get(name)
+            if window is None:
+                for stat in SAMPLE_STATS:
+                    values[statKey(name, stat)] = None
+                continue
+            count, total, low, high = window
+            values[statKey(name, "min")] = low
+            values[statKey(name, "max")] = high
+            values[statKey(name, "mean")] = round(total / count, 3)
+        self._window = {}
+        return values
+
+
+class Sampler:
+    """Samples every device behind a hub at a high rate."""
+
+    def __init__(self, batteryList: list, controllerList: list) -> None:
+        """init."""
+        self.devices = {b: DeviceSampler("battery") for b in batteryList} | {
+            c: DeviceSampler("controller") for c in controllerList
+        }
+
+    async def sample(self, transport: ModbusTransport, skip=()) -> dict:
+        """Read the sampled registers of every device not in skip.
+
+        Returns {deviceId: values} for the devices that answered.
+        """
+        results = {}
+        for deviceId, sampler in self.devices.items():
+            if deviceId in skip:
+                continue
+            values = {}
+            try:
+                for start, wordCount, fields in SAMPLE_PLANS[sampler.deviceType]:
+                    payload = await transport.read_registers(deviceId, start, wordCount)
+                    decodeBlock(payload, fields, values)
+            except (asyncio.TimeoutError, ModbusError) as err:
+                _LOGGER.debug("Failed to sample %s: %s", deviceId, err)
+                continue
+            sampler.add(time.monotonic(), values)
+            results[deviceId] = values
+        return results
+
+    def seed(self, deviceId: int, name: str, total: float) -> None:
+        """Start a device's running total from a restored value."""
+        if (sampler := self.devices.get(deviceId)) is not None:
+            sampler.seed(name, total)
+
+    def publish(self) -> dict:
+        """{deviceId: values} for every device that has been sampled."""
+        return {
+            deviceId: sampler.publish()
+            for deviceId, sampler in self.devices.items()
+            if sampler.samples
+        }
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from bleak import BleakClient, BleakError
+from bleak.backends.device import BLEDevice
+from bleak_retry_connector import establish_connection
+from .stats import CONNECT, START_NOTIFY, LatencyStats
+from .transport import DEFAULT_REQUEST_TIMEOUT, DEFAULT_WINDOW, ModbusTransport
+
+_LOGGER = logging.getLogger(__name__)
+
+# Drop the connection if nothing has used it for this many seconds,
+# None keeps it open until close() is called
+DEFAULT_IDLE_TIMEOUT = 120
+
+
+class RenogySession:
+    """Long lived BLE connection to a BT-2 hub.
+
+    The client is connected on first use and kept open between polls,
+    notifications are re-subscribed whenever the link has to be rebuilt.
+    ble_device can be None until the hub has been seen, see set_ble_device.
+    """
+
+    def __init__(
+        self,
+        ble_device: BLEDevice | None,
+        idle_timeout: float | None = DEFAULT_IDLE_TIMEOUT,
+        request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+        stats: LatencyStats | None = None,
+        write_without_response: bool = True,
+        window: int = DEFAULT_WINDOW,
+    ) -> None:
+        """init."""
+        self.ble_device = ble_device
+        self.write_without_response = write_without_response
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.stats = stats if stats is not None else LatencyStats()
+        self.connects = 0
+        self._client: BleakClient | None = None
+        self._transport: ModbusTransport | None = None
+        self._lock = asyncio.Lock()
+        self._idle_handle: asyncio.TimerHandle | None = None
+
+    @property
+    def is_connected(self) -> bool:
+        return self._client is not None and self._client.is_connected
+
+    @property
+    def transport(self) -> ModbusTransport | None:
+        """Transport of the current connection, if there is one."""
+        return self._transport
+
+    def set_ble_device(self, ble_device: BLEDevice) -> None:
+        """Use a fresher BLEDevice (e.g. a different adapter) on next connect."""
+        self.ble_device = ble_device
+
+    def _on_disconnect(self, client: BleakClient) -> None:
+        _LOGGER.debug("Disconnected from %s", self.ble_device.address)
+        if client is self._client:
+            self._client = None
+            self._transport = None
+
+    async def _connect(self) -> ModbusTransport:
+        if self.is_connected and self._transport is not None:
+            return self._transport
+        _LOGGER.debug("Connecting to %s", self.ble_device.address)
+        with self.stats.measure(CONNECT):
+            client = await establish_connection(
+                BleakClient,
+                self.ble_device,
+                self.ble_device.address,
+                disconnected_callback=self._on_disconnect,
+            )
+        self.connects += 1
+        transport = ModbusTransport(
+            client,
+            self.request_timeout,
+            stats=self.stats,
+            write_without_response=self.write_without_response,
+            window=self.window,
+        )
+        try:
+            with self.stats.measure(START_NOTIFY):
+                await transport.start()
+        except BaseException:
+            await client.disconnect()
+            raise
+        self._client = client
+        self._transport = transport
+        return transport
+
+    def _cancel_idle(self) -> None:
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _schedule_idle(self) -> None:
+        self._cancel_idle()
+        if self.idle_timeout is None:
+            return
+        loop = asyncio.get_running_loop()
+        self._idle_handle = loop.call_later(
+            self.idle_timeout, lambda: loop.create_task(self._idle_disconnect())
+        )
+
+    async def _idle_disconnect(self) -> None:
+        async with self._lock:
+            self._idle_handle = None
+            await self._disconnect()
+
+    async def _disconnect(self) -> None:
+        client = self._client
+        self._client = None
+        self._transport = None
+        if client is not None:
+            _LOGGER.debug("Closing connection to %s", self.ble_device.address)
+            try:
+                await client.disconnect()
+            except BleakError as err:
+                _LOGGER.debug("Error disconnecting: %s", err)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Connect if needed and hand out the transport for one poll cycle."""
+        async with self._lock:
+            self._cancel_idle()
+            transport = await self._connect()
+            try:
+                yield transport
+            except BleakError:
+                # The link is probably dead, rebuild it next time round
+                await self._disconnect()
+                raise
+            finally:
+                if self._client is not None:
+                    self._schedule_idle()
+
+    async def close(self) -> None:
+        """Tear the connection down for good."""
+        async with self._lock:
+            self._cancel_idle()
+            await self._disconnect()
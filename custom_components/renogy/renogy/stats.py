@@ -0,0 +1,85 @@
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Samples kept per key, older ones fall off the end
+DEFAULT_WINDOW = 200
+
+CONNECT = "connect"
+START_NOTIFY = "start_notify"
+CYCLE = "cycle"
+# Time spent waiting for the Bluetooth adapter before a cycle can start
+QUEUE = "queue"
+
+
+def device_key(deviceId: int) -> str:
+    return f"device {deviceId}"
+
+
+def register_key(deviceId: int, register: int) -> str:
+    return f"register {deviceId}/{register}"
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(samples) - 1, math.ceil(pct / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+class LatencyStats:
+    """Rolling latency samples, in seconds, for named steps of a poll.
+
+    Keys are CONNECT, START_NOTIFY, CYCLE, QUEUE, device_key() for every Modbus
+    transaction to a device and register_key() per device and block.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW) -> None:
+        """init."""
+        self.window = window
+        self._samples: dict[str, deque] = {}
+        self.failures: dict[str, int] = {}
+
+    def record(self, key: str, seconds: float) -> None:
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def record_failure(self, key: str) -> None:
+        self.failures[key] = self.failures.get(key, 0) + 1
+
+    @contextmanager
+    def measure(self, *keys: str):
+        """Time a block and record it under every key given."""
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            for key in keys:
+                self.record_failure(key)
+            raise
+        elapsed = time.monotonic() - start
+        for key in keys:
+            self.record(key, elapsed)
+
+    def summary(self, key: str) -> dict | None:
+        """count/last/p50/p95/max for a key, in milliseconds."""
+        samples = self._samples.get(key)
+        if not samples:
+            if key in self.failures:
+                return {"count": 0, "failures": self.failures[key]}
+            return None
+        ordered = sorted(samples)
+        return {
+            "count": len(samples),
+            "last": round(samples[-1] * 1000, 1),
+            "p50": round(percentile(ordered, 50) * 1000, 1),
+            "p95": round(percentile(ordered, 95) * 1000, 1),
+            "max": round(ordered[-1] * 1000, 1),
+            "failures": self.failures.get(key, 0),
+        }
+
+    def as_dict(self) -> dict:
+        keys = set(self._samples) | set(self.failures)
+        return {key: self.summary(key) for key in sorted(keys)}
@@ -0,0 +1,441 @@
+import asyncio
+import logging
+import struct
+import time
+from collections import deque
+from bleak import BleakClient, BleakGATTCharacteristic
+from .Utils import crc16_modbus
+from .stats import LatencyStats, device_key, register_key
+
+_LOGGER = logging.getLogger(__name__)
+
+WRITE_SERVICE_UUID = "0000ffd1-0000-1000-8000-00805f9b34fb"
+NOTIFY_SERVICE_UUID = "0000fff1-0000-1000-8000-00805f9b34fb"
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+
+# Functions whose response carries a byte count in its third byte, the rest
+# answer with a fixed size frame
+BYTE_COUNT_FUNCTIONS = (1, 2, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS)
+FIXED_FRAME_LENGTHS = {5: 8, 6: 8, 15: 8, 16: 8}
+EXCEPTION_FRAME_LENGTH = 5
+
+# Seconds to wait for a device to answer a single request
+DEFAULT_REQUEST_TIMEOUT = 5
+# Requests allowed in flight at once, to different devices
+DEFAULT_WINDOW = 1
+# Requests answered cleanly after a fall back before the configured window
+# is tried again, doubling with every fall back on the same connection
+WINDOW_RESTORE_AFTER = 200
+# Most seconds a (device, function) pair is left alone after a request to
+# it timed out, so a late answer can't be taken for the next request's.
+# Short timeouts wait no longer than the timeout itself.
+LATE_RESPONSE_GUARD = 2.0
+
+
+class ModbusError(Exception):
+    """Device answered with a Modbus exception response."""
+
+    def __init__(self, device_id: int, function: int, code: int) -> None:
+        super().__init__(
+            f"Device {device_id} returned exception {code} for function {function}"
+        )
+        self.device_id = device_id
+        self.function = function
+        self.code = code
+
+
+class ModbusFrameError(ModbusError):
+    """Response didn't match the request it answered."""
+
+    def __init__(self, device_id: int, function: int, message: str) -> None:
+        Exception.__init__(self, message)
+        self.device_id = device_id
+        self.function = function
+        self.code = None
+
+
+class ModbusTimeout(asyncio.TimeoutError):
+    """Device didn't answer a request before its deadline."""
+
+
+def build_read_request(
+    device_id: int, function: int, regAddr: int, readWrd: int
+) -> bytes:
+    """Build a Modbus RTU read request frame, CRC included."""
+    data = struct.pack(">BBHH", device_id, function, regAddr, readWrd)
+    return data + crc16_modbus(data)
+
+
+class FrameCache:
+    """Request frames keyed by (device id, function, register, word count).
+
+    A frame never changes for a given key, so each one is built once and the
+    same immutable bytes are handed to write_gatt_char on every poll.
+    """
+
+    def __init__(self) -> None:
+        """init."""
+        self._frames: dict[tuple[int, int, int, int], bytes] = {}
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def get(self, device_id: int, function: int, regAddr: int, readWrd: int) -> bytes:
+        key = (device_id, function, regAddr, readWrd)
+        frame = self._frames.get(key)
+        if frame is None:
+            frame = self._frames[key] = build_read_request(*key)
+        return frame
+
+    def warm(
+        self, deviceIds: list, blocks: list, function: int = READ_HOLDING_REGISTERS
+    ) -> None:
+        """Build the frames for every block of a read plan up front."""
+        for device_id in deviceIds:
+            for start, wordCount, *_ in blocks:
+                self.get(device_id, function, start, wordCount)
+
+
+# Frames only depend on their key so every connection can share them
+FRAME_CACHE = FrameCache()
+
+
+class FrameDecoder:
+    """Reassembles Modbus RTU response frames from BLE notifications.
+
+    A response can be split over several notifications, so bytes are
+    buffered until a whole frame is in. Frames with a bad CRC are dropped
+    one byte at a time until the stream lines up with a valid frame again.
+    """
+
+    def __init__(self) -> None:
+        """init."""
+        self._buffer = bytearray()
+        self.crc_errors = 0
+
+    def reset(self) -> None:
+        """Throw away any partial frame."""
+        self._buffer.clear()
+
+    @staticmethod
+    def frame_length(buffer) -> int | None:
+        """Length of the frame at the start of buffer, None if not known yet.
+
+        Returns 0 if the start of the buffer can't be a frame at all.
+        """
+        if len(buffer) < 3:
+            return None
+        function = buffer[1]
+        if function & 0x80:
+            return EXCEPTION_FRAME_LENGTH
+        if function in BYTE_COUNT_FUNCTIONS:
+            return 3 + buffer[2] + 2
+        return FIXED_FRAME_LENGTHS.get(function, 0)
+
+    def feed(self, data: bytes) -> list[tuple[int, int, memoryview]]:
+        """Add a notification and return every complete, valid frame.
+
+        Each frame is (device id, function, body) where body is a view of
+        what follows the function code, without the CRC. For an exception
+        response the function keeps its 0x80 bit.
+        """
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        while (length := self.frame_length(buffer)) is not None:
+            if length == 0:
+                del buffer[0]
+                continue
+            if len(buffer) < length:
+                break
+            frame = bytes(buffer[:length])
+            if crc16_modbus(frame[:-2]) != frame[-2:]:
+                self.crc_errors += 1
+                _LOGGER.debug("Dropping byte, bad CRC on: %s", frame.hex())
+                del buffer[0]
+                continue
+            del buffer[:length]
+            frames.append((frame[0], frame[1], memoryview(frame)[2:-2]))
+        return frames
+
+
+class ModbusTransport:
+    """Request/response correlation for Modbus over one BT-2 connection.
+
+    Each request parks a future keyed by (device id, function), the notify
+    callback resolves it when a response with that key and the expected
+    byte count arrives, or fails it with ModbusFrameError if the byte count
+    is wrong. After a timeout the key is poisoned: the next stray or wrong
+    sized response for it is thrown away as the late answer, and the key
+    isn't reused until that arrives or a guard interval has passed. Up to
+    window
+    requests to different devices that have already answered once can be
+    in flight at once. If the hub looks like it can't keep up (answers out
+    of order, late or garbled, or drops a request) the window drops to 1
+    until enough requests have gone through cleanly to try again.
+
+    A device that stops answering isn't the hub's fault. A request that
+    times out while pipelined only counts as dropped if the device answers
+    once it is asked on its own, and only requests that do get answered
+    are checked for order.
+    """
+
+    def __init__(
+        self,
+        client: BleakClient,
+        timeout: float = DEFAULT_REQUEST_TIMEOUT,
+        frames: FrameCache = FRAME_CACHE,
+        stats: LatencyStats | None = None,
+        write_without_response: bool = True,
+        window: int = DEFAULT_WINDOW,
+    ) -> None:
+        """init.
+
+        With write_without_response, requests are written without waiting
+        for an ATT write response if the characteristic allows it. The
+        Modbus response acknowledges the request anyway, and the request
+        timeout covers a write that got lost.
+        """
+        self.client = client
+        self.allow_write_without_response = write_without_response
+        # Decided in start() once we know what the characteristic supports
+        self.write_without_response = False
+        self.timeout = timeout
+        self.frames = frames
+        self.stats = stats
+        self.window = self.configured_window = max(1, window)
+        self.fallbacks = 0
+        # Clean responses since the last fall back
+        self._clean = 0
+        self.decoder = FrameDecoder()
+        self._pending: dict[tuple[int, int], asyncio.Future] = {}
+        # Byte count each pending read expects back
+        self._expected: dict[tuple[int, int], int] = {}
+        # Keys whose last request timed out: until when to avoid them, and
+        # a future resolved when the late response turns up
+        self._poisoned: dict[tuple[int, int], tuple[float, asyncio.Future]] = {}
+        # Keys of the requests in flight, oldest first
+        self._order: deque[tuple[int, int]] = deque()
+        self._waiters: list[asyncio.Future] = []
+        # Devices that have answered on this connection
+        self._answered: set[int] = set()
+        # Devices that timed out while pipelined, sent alone until they
+        # answer again
+        self._suspects: set[int] = set()
+        # Pending requests that a later request was answered before
+        self._overtaken: set[tuple[int, int]] = set()
+
+    def _fall_back(self, reason: str) -> None:
+        if self.window == 1:
+            return
+        _LOGGER.warning(
+            "Hub %s %s, sending one request at a time",
+            getattr(self.client, "address", ""),
+            reason,
+        )
+        self.window = 1
+        self.fallbacks += 1
+        self._clean = 0
+
+    def _count_clean(self) -> None:
+        if self.window == self.configured_window:
+            return
+        self._clean += 1
+        if self._clean < WINDOW_RESTORE_AFTER * 2 ** (self.fallbacks - 1):
+            return
+        _LOGGER.info(
+            "Hub %s has kept up for %s requests, trying %s at a time again",
+            getattr(self.client, "address", ""),
+            self._clean,
+            self.configured_window,
+        )
+        self.window = self.configured_window
+        self._clean = 0
+
+    def _must_wait(self, key: tuple[int, int]) -> bool:
+        if key in self._pending:
+            return True
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.window:
+            return True
+        # Only devices that have answered before share the window, so an ID
+        # with nothing behind it is never mistaken for the hub dropping one
+        return key[0] not in self._answered or any(
+            pending[0] not in self._answered for pending in self._pending
+        )
+
+    async def _acquire(
+        self, key: tuple[int, int], expected: int | None = None
+    ) -> asyncio.Future:
+        """Wait for room in the window and park a future for the response.
+
+        expected is the byte count the response must carry, if it has one.
+        """
+        if (poison := self._poisoned.get(key)) is not None:
+            guard, cleared = poison
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(cleared), max(0, guard - time.monotonic())
+                )
+            except asyncio.TimeoutError:
+                # Stays poisoned, a late answer can still be told apart if
+                # its size gives it away
+                pass
+        while self._must_wait(key):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        if not self._pending:
+            # Leftovers from a request that timed out would corrupt this one
+            self.decoder.reset()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        if expected is not None:
+            self._expected[key] = expected
+        self._order.append(key)
+        return future
+
+    def _release(self, key: tuple[int, int]) -> None:
+        self._pending.pop(key, None)
+        self._expected.pop(key, None)
+        self._overtaken.discard(key)
+        if key in self._order:
+            self._order.remove(key)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _clear_poison(self, key: tuple[int, int]) -> None:
+        if (poison := self._poisoned.pop(key, None)) is not None:
+            if not poison[1].done():
+                poison[1].set_result(None)
+
+    def notification_handler(self, sender: BleakGATTCharacteristic, data: bytearray):
+        """Resolve the outstanding requests that these responses belong to."""
+        crcErrors = self.decoder.crc_errors
+        for device_id, function, body in self.decoder.feed(data):
+            key = (device_id, function & 0x7F)
+            future = self._pending.get(key)
+            mismatch = (
+                future is not None
+                and function in BYTE_COUNT_FUNCTIONS
+                and key in self._expected
+                and body[0] != self._expected[key]
+            )
+            if key in self._poisoned and (future is None or mismatch):
+                # The answer to a request that already timed out
+                _LOGGER.debug("Dropping late response from %s", device_id)
+                self._clear_poison(key)
+                continue
+            if future is None or future.done():
+                _LOGGER.debug(
+                    "Ignoring unexpected response from %s, function %s",
+                    device_id,
+                    function,
+                )
+                if len(self._pending) > 1:
+                    self._fall_back("sent a response nobody was waiting for")
+                continue
+            if mismatch:
+                future.set_exception(
+                    ModbusFrameError(
+                        device_id,
+                        function,
+                        f"Device {device_id} returned {body[0]} bytes, "
+                        f"expected {self._expected[key]}",
+                    )
+                )
+                continue
+            for earlier in self._order:
+                if earlier == key:
+                    break
+                # Only a fault if the earlier one gets answered at all
+                self._overtaken.add(earlier)
+            if key in self._overtaken:
+                self._fall_back("answered out of order")
+            elif device_id in self._suspects:
+                # Timed out in company but answers on its own
+                self._fall_back("dropped a request")
+            else:
+                self._count_clean()
+            self._suspects.discard(device_id)
+            self._answered.add(device_id)
+            # Answering again, a late answer this long after is unlikely
+            self._clear_poison(key)
+            if function & 0x80:
+                future.set_exception(ModbusError(device_id, function & 0x7F, body[0]))
+            elif function in BYTE_COUNT_FUNCTIONS:
+                future.set_result(body[1:])
+            else:
+                future.set_result(body)
+        if self.decoder.crc_errors != crcErrors and len(self._pending) > 1:
+            self._fall_back("garbled a response")
+
+    async def start(self) -> None:
+        """Subscribe to responses from the hub."""
+        await self.client.start_notify(NOTIFY_SERVICE_UUID, self.notification_handler)
+        if self.allow_write_without_response:
+            char = self.client.services.get_characteristic(WRITE_SERVICE_UUID)
+            self.write_without_response = (
+                char is not None and "write-without-response" in char.properties
+            )
+
+    async def read_registers(
+        self,
+        device_id: int,
+        regAddr: int,
+        wordLen: int,
+        timeout: float | None = None,
+    ) -> memoryview:
+        """Read a block of holding registers and return the raw payload.
+
+        timeout overrides the transport's own for this request only.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        key = (device_id, READ_HOLDING_REGISTERS)
+        writeData = self.frames.get(device_id, READ_HOLDING_REGISTERS, regAddr, wordLen)
+        future = await self._acquire(key, wordLen * 2)
+        pipelined = len(self._pending) > 1
+        start = time.monotonic()
+        try:
+            # print(f"About to send: {writeData.hex()}")
+            await self.client.write_gatt_char(
+                WRITE_SERVICE_UUID,
+                writeData,
+                response=not self.write_without_response,
+            )
+            payload = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as err:
+            self._clear_poison(key)
+            self._poisoned[key] = (
+                time.monotonic() + min(timeout, LATE_RESPONSE_GUARD),
+                asyncio.get_running_loop().create_future(),
+            )
+            if self.stats is not None:
+                self.stats.record_failure(device_key(device_id))
+                self.stats.record_failure(register_key(device_id, regAddr))
+            if pipelined or len(self._pending) > 1:
+                # The hub or the device, find out by asking it alone
+                self._answered.discard(device_id)
+                self._suspects.add(device_id)
+            else:
+                self._suspects.discard(device_id)
+            raise ModbusTimeout(
+                f"No response from device {device_id} for register {regAddr}"
+            ) from err
+        finally:
+            self._release(key)
+        if self.stats is not None:
+            elapsed = time.monotonic() - start
+            self.stats.record(device_key(device_id), elapsed)
+            self.stats.record(register_key(device_id, regAddr), elapsed)
+        return payload
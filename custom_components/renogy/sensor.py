@@ -2,13 +2,14 @@
 from __future__ import annotations
 
 from homeassistant.components.sensor import (
+    RestoreSensor,
     SensorDeviceClass,
     SensorEntity,
     SensorEntityDescription,
     SensorStateClass,
 )
-from homeassistant.const import UnitOfTemperature
-from homeassistant.core import HomeAssistant
+from homeassistant.const import EntityCategory, UnitOfTime
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers.device_registry import DeviceInfo, CONNECTION_BLUETOOTH
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
@@ -18,157 +19,193 @@ from homeassistant.helpers.update_coordinator import (
     DataUpdateCoordinator,
 )
 import json
+import time
 
-from .const import DOMAIN
+from .const import DEADBAND_MAX_AGE, DOMAIN
+from .coordinator import RenogyCoordinator
+from .renogy.registers import (
+    BATTERY_PACK_REGISTERS,
+    CELL_TEMPERATURE_REGISTERS,
+    REGISTERS_BY_NAME,
+    Register,
+    deviceRegisters,
+)
+from .renogy.sampling import INTEGRALS, SAMPLE_STATS, SAMPLED_REGISTERS, statKey
+from .renogy.stats import CONNECT, CYCLE, device_key
 
 # address = "80:6F:B0:0F:BD:C1"
 
+
+def _entity_description(r: Register) -> SensorEntityDescription:
+    return SensorEntityDescription(
+        key=r.name,
+        name=r.description,
+        native_unit_of_measurement=r.unit,
+        device_class=SensorDeviceClass(r.deviceClass) if r.deviceClass else None,
+        state_class=SensorStateClass(r.stateClass) if r.stateClass else None,
+        suggested_display_precision=r.precision,
+        options=list(r.options) if r.options else None,
+    )
+
+
+def _sampled_descriptions() -> dict[str, SensorEntityDescription]:
+    """Statistics and totals published by high-rate sampling."""
+    descriptions = {}
+    for name in {n for names in SAMPLED_REGISTERS.values() for n in names}:
+        r = REGISTERS_BY_NAME[name]
+        for stat in SAMPLE_STATS:
+            key = statKey(name, stat)
+            descriptions[key] = _entity_description(
+                r._replace(
+                    name=key,
+                    description=f"{r.description} {stat}",
+                    precision=r.precision + 1 if stat == "mean" else r.precision,
+                )
+            )
+    for integral in INTEGRALS:
+        descriptions[integral.name] = SensorEntityDescription(
+            key=integral.name,
+            name=integral.description,
+            native_unit_of_measurement=integral.unit,
+            device_class=SensorDeviceClass(integral.deviceClass)
+            if integral.deviceClass
+            else None,
+            state_class=SensorStateClass.TOTAL_INCREASING,
+            suggested_display_precision=2,
+        )
+    return descriptions
+
+
+# Built from the register schema the engine polls with, so the two can't drift
 SENSORS_MAPPING_TEMPLATE: dict[str, SensorEntityDescription] = {
-    "remainingCapacity": SensorEntityDescription(
-        key="remainingCapacity",
-        native_unit_of_measurement="Ah",
-        name="Remaining Capacity",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "totalCapacity": SensorEntityDescription(
-        key="totalCapacity",
-        native_unit_of_measurement="Ah",
-        name="Total Capacity",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "current": SensorEntityDescription(
-        key="current",
-        native_unit_of_measurement="A",
-        name="Current",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "voltage": SensorEntityDescription(
-        key="voltage",
-        native_unit_of_measurement="v",
-        name="Voltage",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "dischargeCurentLimit": SensorEntityDescription(
-        key="dischargeCurentLimit",
-        native_unit_of_measurement="A",
-        name="Discharge Curent Limit",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "chargeCurentLimit": SensorEntityDescription(
-        key="chargeCurentLimit",
-        native_unit_of_measurement="A",
-        name="Charge Curent Limit",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "alternatorVoltage": SensorEntityDescription(
-        key="alternatorVoltage",
-        native_unit_of_measurement="v",
-        name="Alternator Voltage",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "alternatorCurrent": SensorEntityDescription(
-        key="alternatorCurrent",
-        native_unit_of_measurement="A",
-        name="Alternator Current",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "alternatorPower": SensorEntityDescription(
-        key="alternatorPower",
-        native_unit_of_measurement="w",
-        name="Alternator Power",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "solarVoltage": SensorEntityDescription(
-        key="solarVoltage",
-        native_unit_of_measurement="v",
-        name="Solar Voltage",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "solarCurrent": SensorEntityDescription(
-        key="solarCurrent",
-        native_unit_of_measurement="A",
-        name="Solar Current",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "solarPower": SensorEntityDescription(
-        key="solarPower",
-        native_unit_of_measurement="w",
-        name="Solar Power",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "cell1Voltage": SensorEntityDescription(
-        key="cell1Voltage",
-        native_unit_of_measurement="v",
-        name="Cell 1 Voltage",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "cell2Voltage": SensorEntityDescription(
-        key="cell2Voltage",
-        native_unit_of_measurement="v",
-        name="Cell 2 Voltage",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "cell3Voltage": SensorEntityDescription(
-        key="cell3Voltage",
-        native_unit_of_measurement="v",
-        name="Cell 3 Voltage",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "cell4Voltage": SensorEntityDescription(
-        key="cell4Voltage",
-        native_unit_of_measurement="v",
-        name="Cell 4 Voltage",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "cell1Temperature": SensorEntityDescription(
-        key="cell1Temperature",
-        native_unit_of_measurement=UnitOfTemperature.CELSIUS,
-        name="Cell 1 Temperature",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "cell2Temperature": SensorEntityDescription(
-        key="cell2Temperature",
-        native_unit_of_measurement=UnitOfTemperature.CELSIUS,
-        name="Cell 2 Temperature",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "cell3Temperature": SensorEntityDescription(
-        key="cell3Temperature",
-        native_unit_of_measurement=UnitOfTemperature.CELSIUS,
-        name="Cell 3 Temperature",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
-    "cell4Temperature": SensorEntityDescription(
-        key="cell4Temperature",
-        native_unit_of_measurement=UnitOfTemperature.CELSIUS,
-        name="Cell 4 Temperature",
-        state_class=SensorStateClass.MEASUREMENT,
-    ),
+    **{name: _entity_description(r) for name, r in REGISTERS_BY_NAME.items()},
+    **_sampled_descriptions(),
 }
 
+# Running totals from sampling, which carry on from their restored state
+INTEGRAL_NAMES = frozenset(i.name for i in INTEGRALS)
+
+
+# (absolute, relative) amount a value has to move by before a new state is
+# written, anything not listed is written whenever it changes at all
+SENSOR_DEADBANDS: dict[str, tuple[float, float]] = {
+    **{r.name: (0.5, 0) for r in CELL_TEMPERATURE_REGISTERS},
+    "remainingCapacity": (0, 0.001),
+    "alternatorPower": (2, 0.01),
+    "solarPower": (2, 0.01),
+}
+DEFAULT_DEADBAND = (0, 0)
+
+
+def renogy_device_info(
+    hubAddress: str, deviceAddress, friendlyName: str, identity: dict | None = None
+) -> DeviceInfo:
+    """Device info for a battery or controller behind a hub."""
+    identity = identity or {}
+    serial = identity.get("serial")
+    return DeviceInfo(
+        identifiers={
+            # Modbus IDs are only unique behind one hub
+            (DOMAIN, f"{hubAddress}_{deviceAddress}")
+        },
+        name=f"Renogy {friendlyName} {deviceAddress}",
+        manufacturer="Renogy",
+        model=identity.get("model") or "Renogy model",
+        sw_version=identity.get("firmware"),
+        serial_number=str(serial) if serial is not None else None,
+        via_device=(DOMAIN, hubAddress),
+    )
+
+
+def expected_sensors(coordinator: RenogyCoordinator) -> dict[int, list[str]]:
+    """Values each configured device will report, before it has been polled."""
+    expected = {}
+    for deviceId, deviceType in [(b, "battery") for b in coordinator.batteryList] + [
+        (c, "controller") for c in coordinator.controllerList
+    ]:
+        if deviceType == "battery":
+            cellCount = coordinator.identity.get(str(deviceId), {}).get("cellCount")
+            # Cell sensors wait for the first poll if the cell count isn't known
+            registers = (
+                deviceRegisters(deviceType, cellCount)
+                if cellCount
+                else BATTERY_PACK_REGISTERS
+            )
+        else:
+            registers = deviceRegisters(deviceType)
+        names = ["address", "type"] + [r.name for r in registers]
+        if coordinator.sampler is not None:
+            names += [
+                statKey(name, stat)
+                for name in SAMPLED_REGISTERS[deviceType]
+                for stat in SAMPLE_STATS
+            ]
+            names += [i.name for i in INTEGRALS if i.deviceType == deviceType]
+        expected[deviceId] = names
+    return expected
+
 
 async def async_setup_entry(hass, config_entry, async_add_entities) -> None:
     """Set up the sensor platform."""
     address = config_entry.data.get("mac")
     friendlyName = config_entry.data.get("friendlyName")
-    print(f"In sensor: {address}")
-    coordinator: DataUpdateCoordinator[str] = hass.data[DOMAIN][address]
-    entities = []
-    # print(SENSORS_MAPPING_TEMPLATE)
-    for device, values in coordinator.data.items():
-        for sensor in values:
-            # print(SENSORS_MAPPING_TEMPLATE.get(sensor))
-            entities.append(
-                RenogySensor(
-                    coordinator,
-                    coordinator,
-                    values.get("address"),
-                    SENSORS_MAPPING_TEMPLATE.get(sensor),
-                    sensor,
-                    friendlyName,
+    coordinator: RenogyCoordinator = hass.data[DOMAIN][config_entry.entry_id]
+    known: set[tuple] = set()
+
+    def new_sensors() -> list[RenogySensor]:
+        """Sensors for values we haven't made an entity for yet."""
+        sensors = []
+        # print(SENSORS_MAPPING_TEMPLATE)
+        # Everything the stored topology says is there, so entities exist
+        # (with restored values) before the first poll, then anything new
+        expected = expected_sensors(coordinator)
+        for device, values in (coordinator.data or {}).items():
+            expected.setdefault(device, []).extend(values)
+        for device, names in expected.items():
+            for sensor in names:
+                if sensor == "available" or (device, sensor) in known:
+                    continue
+                known.add((device, sensor))
+                # print(SENSORS_MAPPING_TEMPLATE.get(sensor))
+                sensors.append(
+                    RenogySensor(
+                        coordinator,
+                        coordinator,
+                        device,
+                        SENSORS_MAPPING_TEMPLATE.get(sensor),
+                        sensor,
+                        friendlyName,
+                        address,
+                    )
                 )
+        return sensors
+
+    @callback
+    def async_add_new_sensors() -> None:
+        # A battery's cell count decides how many cell sensors it has, and
+        # isn't always known by the first refresh
+        if sensors := new_sensors():
+            async_add_entities(sensors)
+
+    entities = new_sensors()
+    entities.append(
+        RenogyLatencySensor(coordinator, CYCLE, "Poll cycle time", friendlyName)
+    )
+    entities.append(
+        RenogyLatencySensor(coordinator, CONNECT, "Connect time", friendlyName)
+    )
+    for deviceId in coordinator.batteryList + coordinator.controllerList:
+        entities.append(
+            RenogyLatencySensor(
+                coordinator,
+                device_key(deviceId),
+                "Response time",
+                friendlyName,
+                deviceId,
             )
+        )
     async_add_entities(entities)
+    config_entry.async_on_unload(coordinator.async_add_listener(async_add_new_sensors))
     # async_add_entities(
     #     [
     #         BatteryRemainingCapacity(coordinator, coordinator.data, 48)
@@ -181,8 +218,11 @@ async def async_setup_entry(hass, config_entry, async_add_entities) -> None:
     # )
 
 
-class RenogySensor(CoordinatorEntity[DataUpdateCoordinator[str]], SensorEntity):
-    """Renogy Sensor"""
+class RenogySensor(CoordinatorEntity[DataUpdateCoordinator[str]], RestoreSensor):
+    """Renogy Sensor
+
+    Shows the value it had before a restart until its device is polled.
+    """
 
     def __init__(
         self,
@@ -192,15 +232,22 @@ class RenogySensor(CoordinatorEntity[DataUpdateCoordinator[str]], SensorEntity):
         entity_description,
         sensorName: str,
         friendlyName: str,
+        hubAddress: str,
     ) -> None:
         """init."""
         super().__init__(coordinator)
+        self._hubaddress = hubAddress
         self._deviceaddress = deviceAddress
         self._sensorname = sensorName
         self._friendlyName = friendlyName
         self._attr_name = self._sensorname
         # f"Renogy {self._deviceaddress} {sensorName}"
-        self._attr_unique_id = f"{self._deviceaddress}_{sensorName}"
+        self._attr_unique_id = f"{hubAddress}_{self._deviceaddress}_{sensorName}"
+        self._deadband = SENSOR_DEADBANDS.get(sensorName, DEFAULT_DEADBAND)
+        self._lastValue = None
+        self._lastAvailable = None
+        self._lastWrite = 0.0
+        self._restored = None
 
         # print(sensorName)
         if entity_description is not None:
@@ -230,33 +277,140 @@ class RenogySensor(CoordinatorEntity[DataUpdateCoordinator[str]], SensorEntity):
     # _attr_device_class = SensorDeviceClass.ENERGY_STORAGE
     # _attr_state_class = SensorStateClass.MEASUREMENT
 
+    def _moved(self, value) -> bool:
+        """Has the value moved past the deadband since we last wrote it."""
+        if not isinstance(value, (int, float)) or not isinstance(
+            self._lastValue, (int, float)
+        ):
+            return value != self._lastValue
+        absolute, relative = self._deadband
+        return abs(value - self._lastValue) > max(
+            absolute, relative * abs(self._lastValue)
+        )
+
+    async def async_added_to_hass(self) -> None:
+        await super().async_added_to_hass()
+        if (last := await self.async_get_last_sensor_data()) is not None:
+            self._restored = last.native_value
+            sampler = self.coordinator.sampler
+            if sampler is not None and self._sensorname in INTEGRAL_NAMES:
+                try:
+                    total = float(last.native_value)
+                except (TypeError, ValueError):
+                    return
+                # Totals would otherwise start from 0 on every restart
+                sampler.seed(self._deviceaddress, self._sensorname, total)
+
+    def _device(self) -> dict | None:
+        """This sensor's device in the latest poll, None if not polled yet."""
+        if self.coordinator.data is None:
+            return None
+        return self.coordinator.data.get(self._deviceaddress)
+
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        """Only write state when the value actually moved, or it's gone stale."""
+        value = self.native_value if self.available else None
+        now = time.monotonic()
+        if (
+            self.available == self._lastAvailable
+            and not self._moved(value)
+            and now - self._lastWrite < DEADBAND_MAX_AGE
+        ):
+            return
+        self._lastValue = value
+        self._lastAvailable = self.available
+        self._lastWrite = now
+        self.async_write_ha_state()
+
     @property
-    def state(self) -> None:
-        """Return the state of the sensor."""
+    def available(self) -> bool:
+        """Unavailable if the hub or just this device stopped answering."""
+        device = self._device()
+        if device is None:
+            # Restored values only stand in until the device is first polled
+            return self._restored is not None and super().available
+        return (
+            super().available
+            and device.get("available", True)
+            and self._sensorname in device
+        )
+
+    @property
+    def native_value(self) -> int | float | str | None:
+        """Return the value of the sensor."""
         # print(self._deviceaddress, self._sensorname)
         # print(self.coordinator.data.get(self._deviceaddress).get(self._sensorname))
-        return self.coordinator.data.get(self._deviceaddress).get(self._sensorname)
+        device = self._device()
+        if device is None:
+            return self._restored
+        return device.get(self._sensorname)
 
     @property
     def device_info(self) -> DeviceInfo:
         """Return the device info."""
-        return DeviceInfo(
-            identifiers={
-                # Serial numbers are unique identifiers within a specific domain
-                (DOMAIN, self._deviceaddress)
-            },
-            connections={
-                (
-                    CONNECTION_BLUETOOTH,
-                    self._deviceaddress,
-                )
-            },
-            name=f"Renogy {self._friendlyName} {self._deviceaddress}",
-            #     name=f"Renogy Name {self._deviceaddress}",
-            manufacturer="Renogy",
-            model="Renogy model",
-            # manufacturer=self.light.manufacturername,
-            # model=self.light.productname,
-            # sw_version=self.light.swversion,
-            # via_device=(hue.DOMAIN, self.api.bridgeid),
+        return renogy_device_info(
+            self._hubaddress,
+            self._deviceaddress,
+            self._friendlyName,
+            self.coordinator.identity.get(str(self._deviceaddress)),
         )
+
+
+class RenogyLatencySensor(CoordinatorEntity[RenogyCoordinator], SensorEntity):
+    """Median latency of one step of polling, with p95/max as attributes.
+
+    Disabled by default, for tuning scan intervals and spotting a device
+    whose link is getting worse.
+    """
+
+    _attr_has_entity_name = True
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_entity_registry_enabled_default = False
+    _attr_device_class = SensorDeviceClass.DURATION
+    _attr_state_class = SensorStateClass.MEASUREMENT
+    _attr_native_unit_of_measurement = UnitOfTime.MILLISECONDS
+
+    def __init__(
+        self,
+        coordinator: RenogyCoordinator,
+        statsKey: str,
+        name: str,
+        friendlyName: str,
+        deviceAddress=None,
+    ) -> None:
+        """init."""
+        super().__init__(coordinator)
+        self._statskey = statsKey
+        self._attr_name = name
+        hubAddress = coordinator.address
+        if deviceAddress is None:
+            self._attr_unique_id = f"{hubAddress}_latency_{statsKey}"
+            self._attr_device_info = DeviceInfo(
+                identifiers={(DOMAIN, hubAddress)},
+                connections={(CONNECTION_BLUETOOTH, hubAddress)},
+                name=f"Renogy {friendlyName}",
+                manufacturer="Renogy",
+                model=coordinator.identity.get("hub", {}).get("model") or "BT-2",
+            )
+        else:
+            self._attr_unique_id = f"{hubAddress}_{deviceAddress}_latency"
+            self._attr_device_info = renogy_device_info(
+                hubAddress,
+                deviceAddress,
+                friendlyName,
+                coordinator.identity.get(str(deviceAddress)),
+            )
+
+    @property
+    def available(self) -> bool:
+        return self.coordinator.stats.summary(self._statskey) is not None
+
+    @property
+    def native_value(self) -> float | None:
+        summary = self.coordinator.stats.summary(self._statskey)
+        return summary.get("p50") if summary else None
+
+    @property
+    def extra_state_attributes(self) -> dict | None:
+        return self.coordinator.stats.summary(self._statskey)